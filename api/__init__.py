@@ -16,3 +16,6 @@
 
 from .metadata import ModelMetadataAPI  # noqa
 from .predict import ModelPredictAPI  # noqa
+from .metrics import ModelMetricsAPI  # noqa
+from .jobs import ModelJobsAPI, ModelJobAPI  # noqa
+from .documents import ModelDocumentsAPI  # noqa
@@ -0,0 +1,54 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from api.predict import ModelPredictAPI, context_example
+from core.documents import DocumentTooLarge
+from maxfw.core import MAX_API
+from flask_restplus import Resource, fields
+from flask_restplus import abort
+
+document_input = MAX_API.model('Document JSON object', {
+    'context': fields.String(required=True, description="Text where answers to questions can be found.",
+                             example=context_example),
+    'base_doc_id': fields.String(required=False, description="`doc_id` of a previous version of the context, only the "
+                                                             "edited part of the context is tokenized again")
+})
+
+document_response = MAX_API.model('ModelDocumentResponse', {
+    'status': fields.String(required=True, description='Response status message'),
+    'doc_id': fields.String(required=True, description='Identifier to send in place of the context, as the `doc_id` '
+                                                       'of a paragraph'),
+    'num_tokens': fields.Integer(description='Number of WordPiece tokens of the context')
+})
+
+
+class ModelDocumentsAPI(Resource):
+
+    @MAX_API.doc('register_document')
+    @MAX_API.expect(document_input, validate=True)
+    @MAX_API.marshal_with(document_response)
+    def post(self):
+        """Register a context, which paragraphs can then refer to by its `doc_id`"""
+        input_json = MAX_API.payload
+        if not input_json.get("context"):
+            abort(400, "Invalid input, please provide a context.")
+
+        try:
+            document = ModelPredictAPI.model_wrapper.documents.add(input_json["context"],
+                                                                   base_doc_id=input_json.get("base_doc_id"))
+        except DocumentTooLarge as e:
+            abort(413, str(e))
+        return {'status': 'ok', 'doc_id': document.doc_id, 'num_tokens': len(document.context)}
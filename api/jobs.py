@@ -0,0 +1,111 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from api.predict import ModelPredictAPI, input_parser, validate_input
+from config import JOB_WORKERS, JOB_QUEUE_SIZE, JOB_RETENTION_COUNT, JOB_RETENTION_SECONDS
+from core.jobs import JobManager, JobQueueFull
+from maxfw.core import MAX_API
+from flask_restplus import Resource, fields
+from flask_restplus import abort
+
+job_response = MAX_API.model('ModelJobResponse', {
+    'status': fields.String(required=True, description='Response status message'),
+    'job_id': fields.String(required=True, description='Identifier of the job'),
+    'job_status': fields.String(required=True, description='One of queued, running, done, failed or cancelled'),
+    'created': fields.Float(description='Time the job was submitted, in seconds since the epoch'),
+    'finished': fields.Float(description='Time the job finished, in seconds since the epoch'),
+    'features_total': fields.Integer(description='Number of features (doc windows) the job runs through the model, '
+                                                 'once it is known'),
+    'features_done': fields.Integer(description='Number of features (doc windows) the model went through'),
+    'predictions': fields.List(fields.List(fields.String),
+                               description='Answers found so far, in input order, one list per paragraph'),
+    'error': fields.String(description='Error message of a failed job')
+})
+
+
+def run_job(job):
+    """Answers the questions of a job, recording its progress and its answers as they are found."""
+    model_wrapper = ModelPredictAPI.model_wrapper
+    input_json = job.payload
+    # the answers found in the cache while counting are the ones the job uses,
+    # so that the features it runs are the ones it counted
+    answers = {}
+    job.features_total = model_wrapper.count_features(input_json, answers=answers)
+
+    predictions = model_wrapper.predict_iter(input_json, progress=job.add_features_done, background=True,
+                                             answers=answers)
+    try:
+        for p in input_json['paragraphs']:
+            job.add_paragraph()
+            for _ in p['questions']:
+                if job.cancelled:
+                    return
+                (_, prediction) = next(predictions)
+                job.add_answer("" if not prediction[0] else prediction[1])
+    finally:
+        # stops the pipeline of a cancelled job
+        predictions.close()
+
+
+job_manager = JobManager(run_job, max_workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE,
+                         retention_count=JOB_RETENTION_COUNT, retention_seconds=JOB_RETENTION_SECONDS)
+
+
+class ModelJobsAPI(Resource):
+
+    @MAX_API.doc('submit_job')
+    @MAX_API.expect(input_parser, validate=True)
+    @MAX_API.marshal_with(job_response, code=202)
+    def post(self):
+        """Submit a prediction job, whose progress and answers are then returned by `GET model/jobs/<job_id>`"""
+        input_json = MAX_API.payload
+        validate_input(input_json)
+
+        try:
+            job = job_manager.submit(input_json)
+        except JobQueueFull as e:
+            abort(429, str(e))
+
+        result = job.to_dict()
+        result['status'] = 'ok'
+        return result, 202
+
+
+class ModelJobAPI(Resource):
+
+    @MAX_API.doc('get_job')
+    @MAX_API.marshal_with(job_response)
+    def get(self, job_id):
+        """Return the progress of a prediction job and the answers found so far"""
+        job = job_manager.get(job_id)
+        if job is None:
+            abort(404, "Job not found, it may have expired.")
+
+        result = job.to_dict()
+        result['status'] = 'ok'
+        return result
+
+    @MAX_API.doc('cancel_job')
+    @MAX_API.marshal_with(job_response)
+    def delete(self, job_id):
+        """Cancel a prediction job, the answers found so far are kept"""
+        job = job_manager.cancel(job_id)
+        if job is None:
+            abort(404, "Job not found, it may have expired.")
+
+        result = job.to_dict()
+        result['status'] = 'ok'
+        return result
@@ -0,0 +1,36 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from api.jobs import job_manager
+from api.predict import ModelPredictAPI
+from maxfw.core import MAX_API
+from flask_restplus import Resource, fields
+
+metrics_response = MAX_API.model('ModelMetricsResponse', {
+    'status': fields.String(required=True, description='Response status message'),
+    'metrics': fields.Raw(description='Runtime metrics of the inference pipeline, grouped by component')
+})
+
+
+class ModelMetricsAPI(Resource):
+
+    @MAX_API.doc('metrics')
+    @MAX_API.marshal_with(metrics_response)
+    def get(self):
+        """Return runtime metrics of the inference pipeline"""
+        metrics = ModelPredictAPI.model_wrapper.metrics()
+        metrics['jobs'] = job_manager.stats()
+        return {'status': 'ok', 'metrics': metrics}
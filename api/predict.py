@@ -14,10 +14,17 @@
 # limitations under the License.
 #
 
+from config import MAX_N_BEST, ANYTIME_THRESHOLD, ANYTIME_ORDER, RETRIEVAL_TOP_K, RETRIEVAL_PASSAGE_SIZE
+from core.documents import UnknownDocument
 from core.model import ModelWrapper
 from maxfw.core import MAX_API, PredictAPI
-from flask_restplus import fields
+from flask import Response, request
+from flask_restplus import fields, marshal
 from flask_restplus import abort
+import json
+import logging
+
+logger = logging.getLogger()
 
 # Set up parser for input data
 # (http://flask-restplus.readthedocs.io/en/stable/parsing.html)
@@ -40,67 +47,207 @@ paragraphs_example = [
   ]
 
 article = MAX_API.model('Article JSON object', {
-    'context': fields.String(required=True, description="Text where answers to questions can be found.",
+    'context': fields.String(required=False, description="Text where answers to questions can be found.",
                              example=context_example),
+    'doc_id': fields.String(required=False, description="Identifier of a context registered with `model/documents`, "
+                                                        "in place of the context."),
     'questions': fields.List(fields.String(required=True, description="Questions to be answered from the context.",
                                            example=question_example))
 })
 
+anytime_options = MAX_API.model('Anytime options', {
+    'threshold': fields.Float(required=False, min=0, max=1, default=ANYTIME_THRESHOLD,
+                              description="The windows of a question stop being run once the probability of its best "
+                                          "span reaches this threshold."),
+    'max_windows': fields.Integer(required=False, min=1,
+                                  description="Maximum number of windows (doc spans) of the request run through the "
+                                              "model, the remaining ones are skipped."),
+    'order': fields.String(required=False, enum=['document', 'overlap'], default=ANYTIME_ORDER,
+                           description="Order the windows of a question are run in, `overlap` runs the windows with "
+                                       "the most question tokens first.")
+})
+
+retrieval_options = MAX_API.model('Retrieval options', {
+    'top_k': fields.Integer(required=False, min=1, default=RETRIEVAL_TOP_K,
+                            description="Number of passages of the context, best matching the question first, whose "
+                                        "windows are run through the model."),
+    'passage_size': fields.Integer(required=False, min=1, default=RETRIEVAL_PASSAGE_SIZE,
+                                   description="Maximum number of WordPiece tokens of a passage, the passages are "
+                                               "made of whole sentences.")
+})
+
 input_parser = MAX_API.model('Data JSON object', {
     'paragraphs': fields.List(fields.Nested(article),
                               description="List of paragraphs, each with a context and follow up questions.",
-                              example=paragraphs_example)
+                              example=paragraphs_example),
+    'n_best': fields.Integer(required=False, min=1, max=MAX_N_BEST,
+                             description="Number of best answer spans to return for each question, with their "
+                                         "probability, in `n_best`."),
+    'anytime': fields.Nested(anytime_options, required=False,
+                             description="Opt in to skip the remaining windows of the questions whose answer is "
+                                         "confident enough, or once a budget of windows ran."),
+    'retrieval': fields.Nested(retrieval_options, required=False,
+                               description="Opt in to only answer each question from the passages of its context "
+                                           "that best match it (BM25), for long contexts.")
 })
 
 # Creating a JSON response model:
 # https://flask-restplus.readthedocs.io/en/stable/marshalling.html#the-api-model-factory
 
+answer_span = MAX_API.model('AnswerSpan', {
+    'text': fields.String(description='Answer text'),
+    'probability': fields.Float(description='Probability of the span among the best spans of the question'),
+    'start_logit': fields.Float(description='Start logit of the span'),
+    'end_logit': fields.Float(description='End logit of the span'),
+    'start_char': fields.Integer(description='Start character offset of the span in its context'),
+    'end_char': fields.Integer(description='End character offset (exclusive) of the span in its context')
+})
+
 predict_response = MAX_API.model('ModelPredictResponse', {
     'status': fields.String(required=True, description='Response status message'),
-    'predictions': fields.List(fields.List(fields.String), description='Predicted answers to questions')
+    'predictions': fields.List(fields.List(fields.String), description='Predicted answers to questions'),
+    'offsets': fields.List(fields.List(fields.List(fields.Integer)),
+                           description='[start, end) character offsets of each answer in its context, null when '
+                                       'there is no answer'),
+    'n_best': fields.List(fields.List(fields.List(fields.Nested(answer_span))),
+                          description='Best answer spans of each question, best first, when `n_best` is given'),
+    'windows_skipped': fields.List(fields.Integer,
+                                   description='Number of windows (doc spans) of each paragraph skipped, when '
+                                               '`anytime` is given')
 })
 
 
+def validate_input(input_json):
+    """Aborts the request with a 400 error (404 for an unknown `doc_id`) if the input is not a valid `input_parser` payload.
+
+    The documents the paragraphs refer to are resolved here, once, and kept in
+    the valid input as the `document` of their paragraph, so that they cannot be
+    evicted before the questions are answered.
+    """
+    documents = []
+    try:
+        for p in input_json["paragraphs"]:
+            if frozenset(p.keys()) == frozenset(["doc_id", "questions"]):
+                try:
+                    documents.append((p, ModelPredictAPI.model_wrapper.documents.resolve(p["doc_id"], record=False)))
+                except UnknownDocument as e:
+                    abort(404, str(e))
+            elif frozenset(p.keys()) != frozenset(["context", "questions"]):
+                abort(400, f"Invalid input paragraph keys {list(p.keys())}, please provide a context and questions.")
+            elif p["context"] == "":
+                abort(400, "Invalid input, please provide a paragraph.")
+            if not isinstance(p["questions"], list):
+                abort(400, "Invalid input, questions should be a list.")
+        n_best = input_json.get("n_best", 1)
+        if isinstance(n_best, bool) or not isinstance(n_best, int) or not 1 <= n_best <= MAX_N_BEST:
+            abort(400, f"Invalid input, n_best should be an integer from 1 to {MAX_N_BEST}.")
+        if "anytime" in input_json:
+            validate_anytime(input_json["anytime"])
+        if "retrieval" in input_json:
+            validate_retrieval(input_json["retrieval"])
+    except KeyError:
+        abort(400, "Invalid input, please check that the input JSON has a `paragraphs` field.")
+    except AssertionError:
+        abort(400, "Invalid input, please ensure that the input JSON has `context` and `questions` fields.")
+    for (p, document) in documents:
+        p["document"] = document
+
+
+def validate_anytime(options):
+    """Aborts the request with a 400 error if the `anytime` options are not valid."""
+    if not isinstance(options, dict) or not set(options) <= {"threshold", "max_windows", "order"}:
+        abort(400, "Invalid input, anytime should be an object of threshold, max_windows and order.")
+    threshold = options.get("threshold", ANYTIME_THRESHOLD)
+    if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or not 0 <= threshold <= 1:
+        abort(400, "Invalid input, the anytime threshold should be a number from 0 to 1.")
+    max_windows = options.get("max_windows", 1)
+    if isinstance(max_windows, bool) or not isinstance(max_windows, int) or max_windows < 1:
+        abort(400, "Invalid input, the anytime max_windows should be a positive integer.")
+    if options.get("order", ANYTIME_ORDER) not in ("document", "overlap"):
+        abort(400, "Invalid input, the anytime order should be document or overlap.")
+
+
+def validate_retrieval(options):
+    """Aborts the request with a 400 error if the `retrieval` options are not valid."""
+    if not isinstance(options, dict) or not set(options) <= {"top_k", "passage_size"}:
+        abort(400, "Invalid input, retrieval should be an object of top_k and passage_size.")
+    for name in ("top_k", "passage_size"):
+        value = options.get(name, 1)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            abort(400, f"Invalid input, the retrieval {name} should be a positive integer.")
+
+
+def paragraph_answers(input_json, predictions):
+    """Groups the `(question id, prediction)` pairs of `ModelWrapper.predict_iter` by paragraph.
+
+    Yields the answers of each paragraph, in input order, as soon as all its
+    questions are answered: a dict of the lists of their `predictions`, their
+    character `offsets` and, if the input asks for them, their `n_best` spans and
+    the number of `windows_skipped` by the anytime mode.
+    """
+    predictions = iter(predictions)
+    for p in input_json['paragraphs']:
+        answers = {'predictions': [], 'offsets': []}
+        if 'n_best' in input_json:
+            answers['n_best'] = []
+        if 'anytime' in input_json:
+            answers['windows_skipped'] = 0
+        for _ in p['questions']:
+            (_, prediction) = next(predictions)
+            answers['predictions'].append("" if not prediction[0] else prediction[1])
+            answers['offsets'].append(None if not prediction[0] or prediction.start_char is None
+                                      else [prediction.start_char, prediction.end_char])
+            if 'n_best' in answers:
+                answers['n_best'].append([] if not prediction[0] else [span._asdict() for span in prediction.n_best or []])
+            if 'windows_skipped' in answers:
+                answers['windows_skipped'] += prediction.windows_skipped
+        yield answers
+
+
 class ModelPredictAPI(PredictAPI):
 
     model_wrapper = ModelWrapper()
 
     @MAX_API.doc('predict')
     @MAX_API.expect(input_parser, validate=True)
-    @MAX_API.marshal_with(predict_response)
+    @MAX_API.response(200, 'Success', predict_response)
+    @MAX_API.produces(['application/json', 'application/x-ndjson'])
     def post(self):
-        """Make a prediction given input data"""
+        """Make a prediction given input data
+
+        With `Accept: application/x-ndjson`, the answers are streamed as they are
+        found, one JSON line of answers per paragraph, in input order.
+        """
         result = {'status': 'error'}
 
         input_json = MAX_API.payload
-        try:
-            for p in input_json["paragraphs"]:
-                if frozenset(p.keys()) != frozenset(["context", "questions"]):
-                    abort(400, f"Invalid input paragraph keys {list(p.keys())}, please provide a context and questions.")
-                if p["context"] == "":
-                    abort(400, "Invalid input, please provide a paragraph.")
-                if not isinstance(p["questions"], list):
-                    abort(400, "Invalid input, questions should be a list.")
-        except KeyError:
-            abort(400, "Invalid input, please check that the input JSON has a `paragraphs` field.")
-        except AssertionError:
-            abort(400, "Invalid input, please ensure that the input JSON has `context` and `questions` fields.")
-
-        preds = self.model_wrapper.predict(input_json)
-        # Create a flat list of answers
-        answers_list = ["" if not preds[p][0] else preds[p][1] for p in preds]
-        # Create a split of how many elements go in each list
-        splits = [len(p['questions']) for p in input_json['paragraphs']]
-        # Create an empty answers list
-        answers = []
-        # Populate this list based on above split of nested lists
-        for i, s in enumerate(splits):
-            if i == 0:
-                answers.append(answers_list[0:s])
-            else:
-                answers.append(answers_list[splits[i-1]:splits[i-1]+s])
-
-        result['predictions'] = answers
+        validate_input(input_json)
+
+        if request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+            return Response(self._stream(input_json), mimetype='application/x-ndjson')
+
+        result['predictions'] = []
+        result['offsets'] = []
+        if 'n_best' in input_json:
+            result['n_best'] = []
+        if 'anytime' in input_json:
+            result['windows_skipped'] = []
+        for answers in paragraph_answers(input_json, self.model_wrapper.predict_iter(input_json)):
+            for (field, values) in answers.items():
+                result[field].append(values)
         result['status'] = 'ok'
 
-        return result
+        return marshal(result, predict_response)
+
+    def _stream(self, input_json):
+        """Yields one line of answers per paragraph, the answers are only computed as the lines are sent."""
+        predictions = self.model_wrapper.predict_iter(input_json)
+        try:
+            for (i, answers) in enumerate(paragraph_answers(input_json, predictions)):
+                yield json.dumps(dict({'status': 'ok', 'paragraph': i}, **answers)) + '\n'
+        except Exception as e:  # the status code was already sent, the error goes in the last line
+            logger.exception('Streaming the predictions failed')
+            yield json.dumps({'status': 'error', 'message': str(e)}) + '\n'
+        finally:
+            # runs when the client disconnects too, the remaining chunks are not computed
+            predictions.close()
@@ -15,10 +15,14 @@
 #
 
 from maxfw.core import MAXApp
-from api import ModelMetadataAPI, ModelPredictAPI
+from api import ModelMetadataAPI, ModelPredictAPI, ModelMetricsAPI, ModelJobsAPI, ModelJobAPI, ModelDocumentsAPI
 from config import API_TITLE, API_DESC, API_VERSION
 
 max = MAXApp(API_TITLE, API_DESC, API_VERSION)
 max.add_api(ModelMetadataAPI, '/metadata')
 max.add_api(ModelPredictAPI, '/predict')
+max.add_api(ModelMetricsAPI, '/metrics')
+max.add_api(ModelJobsAPI, '/jobs')
+max.add_api(ModelJobAPI, '/jobs/<string:job_id>')
+max.add_api(ModelDocumentsAPI, '/documents')
 max.run()
@@ -0,0 +1,61 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Measure model throughput (features per second) against the inference batch size.
+
+Run from the repository root, with the model assets in place:
+
+    python -m benchmarks.batch_size --questions 40
+"""
+
+import argparse
+import time
+
+from core.model import ModelWrapper
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=40, help='number of questions in the request')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per batch size')
+    args = parser.parse_args()
+
+    context = open('tests/einstein.txt').read()
+    questions = ['What did Albert Einstein discover?', 'What prize did Einstein receive?']
+    payload = {'paragraphs': [{'context': context,
+                               'questions': [questions[i % len(questions)] for i in range(args.questions)]}]}
+
+    model_wrapper = ModelWrapper()
+    # every timed run goes through the model, not through the window logits cache
+    model_wrapper.window_cache.max_size = 0
+    model_wrapper.answer_cache.max_size = 0
+    features, examples = model_wrapper._pre_process(payload)
+    # warm up the session so graph initialization is not part of the first timing
+    model_wrapper._predict((features, examples))
+
+    print('{:>10} {:>12} {:>14}'.format('batch size', 'seconds', 'features/sec'))
+    for batch_size in args.batch_sizes:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            model_wrapper._predict((features, examples), batch_size=batch_size)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print('{:>10} {:>12.3f} {:>14.1f}'.format(batch_size, best, len(features) / best))
+
+
+if __name__ == '__main__':
+    main()
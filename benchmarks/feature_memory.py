@@ -0,0 +1,113 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Measure the peak memory of converting a bulk request into features.
+
+Compares the array-backed InputFeatureBatch built by convert_examples_to_features
+with the previous representation, where every window held a list of token
+strings, two dicts mapping its positions and Python lists of ids. Each
+representation is built in a fresh process, whose peak RSS is reported. Run
+from the repository root, with the model assets in place:
+
+    python -m benchmarks.feature_memory --questions 10000
+"""
+
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+
+from benchmarks.samples import sample_contexts
+from core.run_squad import read_squad_examples, convert_examples_to_features
+from core.tokenization import FullTokenizer
+
+
+def bulk_request(num_questions, questions_per_paragraph):
+    """A request of `num_questions` questions about the sample contexts, each paragraph a distinct context."""
+    (contexts, questions) = sample_contexts()
+    paragraphs = []
+    for start in range(0, num_questions, questions_per_paragraph):
+        # a different paragraph number keeps the contexts from being shared across paragraphs
+        index = len(paragraphs)
+        context = '{} ({})'.format(contexts[index % len(contexts)], index)
+        paragraph_questions = [{'id': str(i), 'question': questions[i % len(questions)]}
+                               for i in range(start, min(start + questions_per_paragraph, num_questions))]
+        paragraphs.append({'context': context, 'questions': paragraph_questions})
+    return {'paragraphs': paragraphs}
+
+
+def legacy_features(batch):
+    """The features of a batch as they were held before, one set of lists and dicts per window.
+
+    They are built from the batch, so the legacy peak also includes the arrays of the batch.
+    """
+    features = []
+    for feature in batch:
+        features.append((feature.unique_id, feature.example_index, feature.doc_span_index, feature.tokens,
+                         feature.token_to_orig_map, feature.token_is_max_context, feature.input_ids.tolist(),
+                         feature.input_mask.tolist(), feature.segment_ids.tolist()))
+    return features
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def measure(representation, args, results):
+    tokenizer = FullTokenizer(vocab_file=args.vocab, do_lower_case=True)
+    request = bulk_request(args.questions, args.questions_per_paragraph)
+    baseline = peak_rss_mb()
+
+    start = time.perf_counter()
+    examples = read_squad_examples(request)
+    features = convert_examples_to_features(examples, tokenizer, args.max_seq_length, args.doc_stride,
+                                            args.max_query_length)
+    if representation == 'legacy':
+        # the previous converter kept the per-window lists and dicts of every feature
+        features = legacy_features(features)
+    seconds = time.perf_counter() - start
+
+    results.put((representation, len(features), seconds, baseline, peak_rss_mb()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vocab', default='assets/vocab.txt')
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--questions-per-paragraph', type=int, default=10)
+    parser.add_argument('--max-seq-length', type=int, default=512)
+    parser.add_argument('--doc-stride', type=int, default=128)
+    parser.add_argument('--max-query-length', type=int, default=64)
+    args = parser.parse_args()
+
+    # a fresh interpreter per representation, so each peak RSS is its own
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+
+    print('{:>10} {:>10} {:>10} {:>16} {:>16}'.format('features', 'windows', 'seconds', 'start RSS (MB)',
+                                                      'peak RSS (MB)'))
+    for representation in ['legacy', 'arrays']:
+        process = context.Process(target=measure, args=(representation, args, results))
+        process.start()
+        (representation, windows, seconds, baseline, peak) = results.get()
+        process.join()
+        print('{:>10} {:>10} {:>10.3f} {:>16.1f} {:>16.1f}'.format(representation, windows, seconds, baseline, peak))
+
+
+if __name__ == '__main__':
+    main()
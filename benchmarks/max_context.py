@@ -0,0 +1,59 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Measure how the max-context computation of doc spans scales with the context length.
+
+Compares the one-pass computation used by convert_examples_to_features with
+calling _check_is_max_context (which scans every doc span) for each token of
+each span. Run from the repository root:
+
+    python -m benchmarks.max_context --doc-stride 64
+"""
+
+import argparse
+import time
+
+from core.run_squad import _check_is_max_context, _doc_span_layout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lengths', type=int, nargs='+', default=[1000, 5000, 20000, 50000, 100000, 200000],
+                        help='context lengths, in WordPiece tokens')
+    parser.add_argument('--max-tokens-for-doc', type=int, default=497, help='doc tokens per window')
+    parser.add_argument('--doc-stride', type=int, default=128)
+    parser.add_argument('--max-scan-length', type=int, default=20000,
+                        help='longest context the per-token scan is timed on, it is quadratic')
+    args = parser.parse_args()
+
+    print('{:>8} {:>8} {:>14} {:>14}'.format('tokens', 'spans', 'scan (s)', 'one pass (s)'))
+    for length in args.lengths:
+        start = time.perf_counter()
+        doc_spans, max_context_span = _doc_span_layout(length, args.max_tokens_for_doc, args.doc_stride)
+        one_pass = time.perf_counter() - start
+
+        scan = float('nan')
+        if length <= args.max_scan_length:
+            start = time.perf_counter()
+            for (span_index, doc_span) in enumerate(doc_spans):
+                for i in range(doc_span.length):
+                    _check_is_max_context(doc_spans, span_index, doc_span.start + i)
+            scan = time.perf_counter() - start
+
+        print('{:>8} {:>8} {:>14.3f} {:>14.3f}'.format(length, len(doc_spans), scan, one_pass))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Measure the latency and accuracy trade-off of the passage retriever on a long document.
+
+The sample contexts are joined into one long document, and the questions of all
+of them are asked about it, without retrieval and then with the `top_k` and
+`passage_size` retrieval options. Each run reports its latency, the number of
+windows run through the model and how many answers match the answers found in
+the whole document (exactly, and by token F1). Run from the repository root,
+with the model assets in place:
+
+    python -m benchmarks.retrieval --copies 4
+"""
+
+import argparse
+import collections
+import copy
+import time
+
+from benchmarks.samples import sample_contexts
+from core.model import ModelWrapper
+
+
+def long_document(copies):
+    """The sample contexts joined into one document, `copies` times, with the questions about them."""
+    (contexts, questions) = sample_contexts()
+    questions = ['What did Albert Einstein discover?', 'What prize did Einstein receive?'] + questions
+    return '\n\n'.join(contexts * copies), questions
+
+
+def f1(answer, reference):
+    """The token F1 of an answer against a reference answer, as in the SQuAD evaluation."""
+    answer_tokens = answer.lower().split()
+    reference_tokens = reference.lower().split()
+    if not answer_tokens or not reference_tokens:
+        return float(answer_tokens == reference_tokens)
+    common = sum((collections.Counter(answer_tokens) & collections.Counter(reference_tokens)).values())
+    if common == 0:
+        return 0.0
+    precision = common / len(answer_tokens)
+    recall = common / len(reference_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--copies', type=int, default=4, help='number of copies of the sample contexts in the document')
+    parser.add_argument('--top-k', type=int, nargs='+', default=[1, 3, 5])
+    parser.add_argument('--passage-sizes', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per setting')
+    args = parser.parse_args()
+
+    (document, questions) = long_document(args.copies)
+    model_wrapper = ModelWrapper()
+    # every run goes through the model
+    model_wrapper.answer_cache.max_size = 0
+    model_wrapper.window_cache.max_size = 0
+
+    def run(retrieval):
+        payload = {'paragraphs': [{'context': document, 'questions': list(questions)}]}
+        if retrieval is not None:
+            payload['retrieval'] = retrieval
+        windows = model_wrapper.count_features(copy.deepcopy(payload))
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            predictions = list(model_wrapper.predict_iter(copy.deepcopy(payload)))
+            timings.append(time.perf_counter() - start)
+        answers = ["" if not prediction[0] else prediction[1] for (_, prediction) in predictions]
+        return min(timings), windows, answers
+
+    # warm up the session and the context cache so they are not part of the first timing
+    run(None)
+    (full_seconds, full_windows, reference) = run(None)
+    print('{} questions about a document of {} WordPiece tokens'.format(
+        len(questions), len(model_wrapper._get_context({'context': document}))))
+    print('{:>6} {:>12} {:>10} {:>10} {:>9} {:>12} {:>8}'.format(
+        'top_k', 'passage size', 'windows', 'seconds', 'speedup', 'exact match', 'F1'))
+    print('{:>6} {:>12} {:>10} {:>10.3f} {:>9.2f} {:>12.3f} {:>8.3f}'.format(
+        'all', '-', full_windows, full_seconds, 1.0, 1.0, 1.0))
+    for passage_size in args.passage_sizes:
+        for top_k in args.top_k:
+            (seconds, windows, answers) = run({'top_k': top_k, 'passage_size': passage_size})
+            exact = sum(a == r for (a, r) in zip(answers, reference)) / len(reference)
+            mean_f1 = sum(f1(a, r) for (a, r) in zip(answers, reference)) / len(reference)
+            print('{:>6} {:>12} {:>10} {:>10.3f} {:>9.2f} {:>12.3f} {:>8.3f}'.format(
+                top_k, passage_size, windows, seconds, full_seconds / seconds, exact, mean_f1))
+
+
+if __name__ == '__main__':
+    main()
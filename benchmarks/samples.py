@@ -0,0 +1,37 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""The sample contexts and questions of the repository, shared by the benchmarks and the tests."""
+
+import json
+
+SAMPLE_FILES = ['samples/small-dev.json', 'samples/example-data.json']
+
+
+def sample_contexts():
+    """The sample contexts and the questions about them, as two lists of strings.
+
+    The contexts are `tests/einstein.txt` and those of the sample requests, read
+    from the repository root.
+    """
+    with open('tests/einstein.txt') as f:
+        contexts = [f.read()]
+    questions = []
+    for file_name in SAMPLE_FILES:
+        with open(file_name) as f:
+            for paragraph in json.load(f)['paragraphs']:
+                contexts.append(paragraph['context'])
+                questions.extend(q if isinstance(q, str) else q['question'] for q in paragraph['questions'])
+    return contexts, questions
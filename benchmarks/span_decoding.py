@@ -0,0 +1,89 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Compare the vectorized span decoder with the previous 10x10 candidate loop.
+
+Run from the repository root:
+
+    python -m benchmarks.span_decoding --windows 256
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from core.decoding import best_spans
+
+
+def loop_decoder(start_logits, end_logits, token_to_orig_map, token_is_max_context, max_answer_length, n_best_size=10):
+    """The previous decoder: the first valid pair of the 10 best start and end positions."""
+    def best_indexes(logits):
+        return [i for (i, _) in sorted(enumerate(logits), key=lambda x: x[1], reverse=True)[:n_best_size]]
+
+    for start_index in best_indexes(start_logits):
+        for end_index in best_indexes(end_logits):
+            if start_index not in token_to_orig_map or end_index not in token_to_orig_map:
+                continue
+            if not token_is_max_context.get(start_index, False):
+                continue
+            if end_index < start_index or end_index - start_index + 1 >= max_answer_length:
+                continue
+            return start_index, end_index
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--windows', type=int, default=256, help='number of windows to decode')
+    parser.add_argument('--seq-length', type=int, default=512)
+    parser.add_argument('--max-answer-length', type=int, default=30)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    start_logits = rng.randn(args.windows, args.seq_length).astype(np.float32)
+    end_logits = rng.randn(args.windows, args.seq_length).astype(np.float32)
+    # a 20 token question followed by the document, the last tokens of the window are padding
+    doc_start, doc_end = 22, args.seq_length - 40
+    end_mask = np.zeros((args.windows, args.seq_length), dtype=bool)
+    end_mask[:, doc_start:doc_end] = True
+    start_mask = end_mask & (rng.rand(args.windows, args.seq_length) < 0.8)
+
+    token_to_orig_map = [{p: p for p in range(doc_start, doc_end)} for _ in range(args.windows)]
+    token_is_max_context = [{p: bool(start_mask[i, p]) for p in range(doc_start, doc_end)} for i in range(args.windows)]
+
+    start = time.perf_counter()
+    loop_spans = [loop_decoder(start_logits[i].tolist(), end_logits[i].tolist(), token_to_orig_map[i],
+                               token_is_max_context[i], args.max_answer_length) for i in range(args.windows)]
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    start_indexes, end_indexes, scores = best_spans(start_logits, end_logits, start_mask, end_mask,
+                                                    args.max_answer_length)
+    vectorized_time = time.perf_counter() - start
+
+    worse = 0
+    for (i, span) in enumerate(loop_spans):
+        if span is None or start_logits[i, span[0]] + end_logits[i, span[1]] < scores[i, 0]:
+            worse += 1
+
+    print('{:>12} {:>14} {:>16}'.format('decoder', 'ms / window', 'windows / sec'))
+    for (name, seconds) in [('loop', loop_time), ('vectorized', vectorized_time)]:
+        print('{:>12} {:>14.4f} {:>16.1f}'.format(name, 1000.0 * seconds / args.windows, args.windows / seconds))
+    print('the loop missed the best scoring span in {} of {} windows'.format(worse, args.windows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Measure the speedup of the FullTokenizer word cache on a repeated-document workload.
+
+Every sample context and question is tokenized `--repeat` times, as they
+would be by requests asking about the same documents. Run from the
+repository root, with the model assets in place:
+
+    python -m benchmarks.word_cache --repeat 50
+"""
+
+import argparse
+import time
+
+from benchmarks.samples import sample_contexts
+from config import WORD_CACHE_SIZE
+from core.tokenization import FullTokenizer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vocab', default='assets/vocab.txt')
+    parser.add_argument('--repeat', type=int, default=50, help='number of times each text is tokenized')
+    parser.add_argument('--cache-size', type=int, default=WORD_CACHE_SIZE)
+    args = parser.parse_args()
+
+    (contexts, questions) = sample_contexts()
+    texts = (contexts + questions) * args.repeat
+
+    print('{:>10} {:>12} {:>14} {:>10}'.format('word cache', 'seconds', 'texts/sec', 'hit rate'))
+    for cache_size in [0, args.cache_size]:
+        tokenizer = FullTokenizer(vocab_file=args.vocab, do_lower_case=True, word_cache_size=cache_size)
+        start = time.perf_counter()
+        for text in texts:
+            tokenizer.tokenize_to_ids(text)
+        seconds = time.perf_counter() - start
+        hit_rate = tokenizer.word_cache.stats()['hit_rate'] if tokenizer.word_cache is not None else 0.0
+        print('{:>10} {:>12.3f} {:>14.1f} {:>10.3f}'.format(cache_size, seconds, len(texts) / seconds, hit_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Measure WordPiece tokenization throughput on tests/einstein.txt.
+
+Compares the trie-based WordpieceTokenizer with the previous greedy
+longest-match loop. Run from the repository root, with the model assets in place:
+
+    python -m benchmarks.wordpiece --repeat 200
+"""
+
+import argparse
+import time
+
+from core.tokenization import BasicTokenizer, WordpieceTokenizer, load_vocab
+
+
+def greedy_wordpiece(vocab, token):
+    """The previous WordPiece matcher, which tries every shrinking substring at each position."""
+    chars = list(token)
+    start = 0
+    sub_tokens = []
+    while start < len(chars):
+        end = len(chars)
+        cur_substr = None
+        while start < end:
+            substr = "".join(chars[start:end])
+            if start > 0:
+                substr = "##" + substr
+            if substr in vocab:
+                cur_substr = substr
+                break
+            end -= 1
+        if cur_substr is None:
+            return ["[UNK]"]
+        sub_tokens.append(cur_substr)
+        start = end
+    return sub_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vocab', default='assets/vocab.txt')
+    parser.add_argument('--repeat', type=int, default=200, help='number of passes over the text')
+    args = parser.parse_args()
+
+    vocab = load_vocab(args.vocab)
+    words = BasicTokenizer(do_lower_case=True).tokenize(open('tests/einstein.txt').read()) * args.repeat
+    tokenizer = WordpieceTokenizer(vocab=vocab)
+
+    start = time.perf_counter()
+    greedy_pieces = [piece for word in words for piece in greedy_wordpiece(vocab, word)]
+    greedy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    trie_pieces = [piece for word in words for piece in tokenizer.tokenize(word)]
+    trie_time = time.perf_counter() - start
+
+    print('{:>8} {:>12} {:>14}'.format('matcher', 'seconds', 'words/sec'))
+    for (name, seconds) in [('greedy', greedy_time), ('trie', trie_time)]:
+        print('{:>8} {:>12.3f} {:>14.0f}'.format(name, seconds, len(words) / seconds))
+    print('identical output: {}'.format(greedy_pieces == trie_pieces))
+
+
+if __name__ == '__main__':
+    main()
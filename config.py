@@ -29,3 +29,70 @@ API_VERSION = '2.0.0'
 # default model
 MODEL_NAME = 'max_qa_model'
 DEFAULT_MODEL_PATH = 'assets/{}'.format(MODEL_NAME)
+
+# Inference settings
+# maximum number of features (doc windows) run through the model at once
+PREDICT_BATCH_SIZE = 32
+# maximum number of features (doc windows) of a request in flight at once, larger
+# requests are converted, run and answered in chunks of about this many windows
+STREAM_MAX_WINDOWS = 256
+# tokenize and decode the chunks of a request in threads of their own, while the model
+# runs the previous chunk
+PIPELINING = True
+# number of chunks a stage of the pipeline may get ahead of the next one
+PIPELINE_QUEUE_SIZE = 2
+
+# largest number of best spans (`n_best`) a request may ask for each question
+MAX_N_BEST = 20
+
+# requests with `anytime` options stop running the windows of a question once its best span has this probability
+ANYTIME_THRESHOLD = 0.9
+# order the windows of a question are run in with `anytime` options: `document` or `overlap` (most question tokens first)
+ANYTIME_ORDER = 'document'
+
+# requests with `retrieval` options only run the windows of the `top_k` passages that best match each question,
+# passages of whole sentences of up to `passage_size` WordPiece tokens ranked with BM25
+RETRIEVAL_TOP_K = 3
+RETRIEVAL_PASSAGE_SIZE = 128
+
+# queue the features of concurrent requests into shared model batches
+MICRO_BATCHING = True
+# optional limit on the real (unpadded) tokens in a batch, `None` to only limit the number of features
+MAX_BATCH_TOKENS = None
+# how long a queued feature may wait for its batch to fill up
+MAX_BATCH_WAIT_MS = 5
+# sequence lengths each batch is padded to, when the model was exported with a dynamic sequence length
+SEQ_LENGTH_BUCKETS = [64, 128, 256, 384, 512]
+
+# number of distinct words whose WordPiece tokenization is memoized by the tokenizer
+WORD_CACHE_SIZE = 100000
+# maximum number of WordPiece tokens of the tokenized contexts cached across requests
+CONTEXT_CACHE_MAX_TOKENS = 1000000
+
+# answers are cached across requests, bounded in (approximate) bytes, and expire after `ANSWER_CACHE_TTL` seconds
+ANSWER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+ANSWER_CACHE_TTL = 3600
+# optional local file the answer cache is saved to (every `ANSWER_CACHE_SAVE_INTERVAL` seconds and at exit)
+# and loaded from at startup, so that it survives restarts
+ANSWER_CACHE_FILE = None
+ANSWER_CACHE_SAVE_INTERVAL = 300
+# logits of the windows (doc spans) run through the model, bounded in bytes, so that after an edit
+# of a context only the windows whose tokens changed are run again, 0 disables the cache
+WINDOW_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# contexts registered with `model/documents` are kept in memory up to this many WordPiece tokens
+DOCUMENT_STORE_MAX_TOKENS = 5000000
+# optional SQLite database file the registered documents are saved to, so that they survive evictions and restarts
+DOCUMENT_DB_FILE = None
+# maximum number of documents kept in the database, the least recently used ones are deleted
+DOCUMENT_DB_MAX_DOCUMENTS = 10000
+
+# Asynchronous job settings (`model/jobs`)
+# number of jobs run at the same time, their features give way to the ones of `model/predict` requests
+JOB_WORKERS = 2
+# maximum number of jobs waiting for a worker, more submissions are rejected
+JOB_QUEUE_SIZE = 100
+# maximum number of finished jobs whose answers are kept
+JOB_RETENTION_COUNT = 1000
+# how long the answers of a finished job are kept, in seconds
+JOB_RETENTION_SECONDS = 3600
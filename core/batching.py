@@ -0,0 +1,246 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger()
+
+
+class _PendingRequest(object):
+    """The features of one request waiting for (or going through) the model."""
+
+    def __init__(self, input_ids, input_mask, segment_ids, length_buckets=None):
+        self.input_ids = input_ids
+        self.input_mask = input_mask
+        self.segment_ids = segment_ids
+        # the rows are taken in `order`, shortest length bucket first when
+        # there are buckets, `next_row` and the batch segments index this order
+        self.buckets = None
+        self.order = np.arange(len(input_ids))
+        if length_buckets is not None:
+            buckets = np.searchsorted(length_buckets, input_mask.sum(axis=1))
+            self.order = np.argsort(buckets, kind='mergesort')
+            self.buckets = buckets[self.order]
+        self.lengths = input_mask.sum(axis=1)[self.order]
+        self.start_logits = np.zeros(input_ids.shape, dtype=np.float32)
+        self.end_logits = np.zeros(input_ids.shape, dtype=np.float32)
+        self.enqueued = time.monotonic()
+        self.next_row = 0
+        self.rows_done = 0
+        self.error = None
+        self._done = threading.Event()
+        if len(input_ids) == 0:
+            self._done.set()
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def result(self):
+        """Block until all the features of the request went through the model."""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.start_logits, self.end_logits
+
+    def _finish_rows(self, count):
+        self.rows_done += count
+        if self.rows_done == len(self):
+            self._done.set()
+
+    def _fail(self, error):
+        self.error = error
+        self._done.set()
+
+
+class BatchScheduler(object):
+    """Groups the features of concurrent requests into shared model batches.
+
+    Requests are queued by `submit`. A single worker thread takes features from
+    the head of the queue until the batch holds `max_batch_size` features (or
+    `max_batch_tokens` real tokens), or until the oldest queued feature has
+    waited `max_wait_ms`, then runs the whole batch with one `run_batch` call
+    and hands every request back the logits of its own features. Background
+    requests only get the room the other requests leave in a batch.
+
+    With `length_buckets`, the features of each request are taken shortest
+    first, and a batch only holds features that fit in the length bucket of
+    the next feature of the oldest request, so that one long feature does not
+    pad a whole batch of short ones to its length.
+    """
+
+    def __init__(self, run_batch, max_batch_size=32, max_batch_tokens=None, max_wait_ms=5.0, length_buckets=None):
+        """Constructs a BatchScheduler.
+
+        Args:
+          run_batch: callable taking `input_ids`, `input_mask` and `segment_ids`
+            matrices and returning the `start_logits` and `end_logits` matrices.
+          max_batch_size: maximum number of features in a batch.
+          max_batch_tokens: optional maximum number of real (unpadded) tokens
+            in a batch.
+          max_wait_ms: how long a feature may wait for the batch to fill up.
+          length_buckets: optional sorted array of the sequence lengths the
+            batches are padded to, when the model takes any sequence length.
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait_ms / 1000.0
+        self.length_buckets = length_buckets
+
+        self._pending = collections.deque()
+        self._background = collections.deque()
+        self._queued_rows = 0
+        self._queued_tokens = 0
+        self._cond = threading.Condition()
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._rows = 0
+        self._fill = 0.0
+        self._wait = 0.0
+        self._max_wait = 0.0
+
+        self._worker = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._worker.start()
+
+    def submit(self, input_ids, input_mask, segment_ids, background=False):
+        """Queues the features of a request, returns an object whose `result()` gives their logits.
+
+        The features of `background` requests go through the model after the
+        features of the other requests queued before the batch is formed.
+        """
+        request = _PendingRequest(input_ids, input_mask, segment_ids, self.length_buckets)
+        if len(request) == 0:
+            return request
+
+        with self._cond:
+            (self._background if background else self._pending).append(request)
+            self._queued_rows += len(request)
+            self._queued_tokens += int(request.lengths.sum())
+            self._cond.notify()
+        return request
+
+    def stats(self):
+        """Returns the queue and batching metrics of the scheduler."""
+        with self._stats_lock:
+            batches = max(self._batches, 1)
+            rows = max(self._rows, 1)
+            return {
+                'queue_depth': self._queued_rows,
+                'batches': self._batches,
+                'features': self._rows,
+                'mean_batch_size': self._rows / batches,
+                'mean_batch_fill_ratio': self._fill / batches,
+                'mean_wait_ms': 1000.0 * self._wait / rows,
+                'max_wait_ms': 1000.0 * self._max_wait,
+            }
+
+    def _is_full(self):
+        if self._queued_rows >= self.max_batch_size:
+            return True
+        return self.max_batch_tokens is not None and self._queued_tokens >= self.max_batch_tokens
+
+    def _next_batch(self):
+        """Waits for a batch to fill up (or its deadline to pass), returns its (request, start, stop) segments."""
+        with self._cond:
+            while not self._pending and not self._background:
+                self._cond.wait()
+
+            deadline = min(queue[0].enqueued for queue in [self._pending, self._background] if queue) + self.max_wait
+            while not self._is_full():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            segments = []
+            rows = 0
+            tokens = 0
+            # the length bucket of the batch is the one of the next feature of the oldest request
+            bucket = None
+            if self.length_buckets is not None:
+                head = self._pending[0] if self._pending else self._background[0]
+                bucket = head.buckets[head.next_row]
+            for queue in [self._pending, self._background]:
+                index = 0
+                while index < len(queue) and rows < self.max_batch_size:
+                    request = queue[index]
+                    start = request.next_row
+                    stop = start
+                    while stop < len(request) and rows < self.max_batch_size:
+                        if bucket is not None and request.buckets[stop] > bucket:
+                            break
+                        row_tokens = int(request.lengths[stop])
+                        if self.max_batch_tokens is not None and rows > 0 and \
+                                tokens + row_tokens > self.max_batch_tokens:
+                            break
+                        tokens += row_tokens
+                        rows += 1
+                        stop += 1
+                    if stop > start:
+                        segments.append((request, start, stop))
+                    request.next_row = stop
+                    if stop == len(request):
+                        del queue[index]
+                    elif bucket is not None and request.buckets[stop] > bucket and rows < self.max_batch_size:
+                        # the remaining features of this request are longer than the batch, they wait
+                        index += 1
+                    else:
+                        # the batch ran out of room part way through this request
+                        break
+
+            self._queued_rows -= rows
+            self._queued_tokens -= tokens
+        return segments, rows
+
+    def _record(self, segments, rows, started):
+        with self._stats_lock:
+            self._batches += 1
+            self._rows += rows
+            self._fill += rows / float(self.max_batch_size)
+            for (request, start, stop) in segments:
+                wait = started - request.enqueued
+                self._wait += wait * (stop - start)
+                self._max_wait = max(self._max_wait, wait)
+
+    def _run(self):
+        while True:
+            segments, rows = self._next_batch()
+            started = time.monotonic()
+            self._record(segments, rows, started)
+            try:
+                start_logits, end_logits = self.run_batch(
+                    np.concatenate([r.input_ids[r.order[start:stop]] for (r, start, stop) in segments]),
+                    np.concatenate([r.input_mask[r.order[start:stop]] for (r, start, stop) in segments]),
+                    np.concatenate([r.segment_ids[r.order[start:stop]] for (r, start, stop) in segments]))
+            except Exception as e:  # the error belongs to the requests, not to the worker
+                logger.exception('Batch of %d features failed', rows)
+                for (request, _, _) in segments:
+                    request._fail(e)
+                continue
+
+            offset = 0
+            for (request, start, stop) in segments:
+                count = stop - start
+                request.start_logits[request.order[start:stop]] = start_logits[offset:offset + count]
+                request.end_logits[request.order[start:stop]] = end_logits[offset:offset + count]
+                offset += count
+                request._finish_rows(count)
@@ -0,0 +1,130 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe least-recently-used cache, bounded by the total size of its values."""
+
+    def __init__(self, max_size, sizeof=None, ttl=None):
+        """Constructs a LRUCache.
+
+        Args:
+          max_size: maximum total size of the cached values. Least recently used
+            entries are evicted to make room for new ones.
+          sizeof: optional callable returning the size of a value, by default
+            every value has a size of 1 (the cache is bounded in entries).
+          ttl: optional number of seconds after which an entry expires.
+        """
+        self.max_size = max_size
+        self.sizeof = sizeof if sizeof is not None else (lambda value: 1)
+        self.ttl = ttl
+
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        """Whether `key` has an entry that did not expire, without marking it used or counting a lookup."""
+        with self._lock:
+            return self._live_entry(key) is not None
+
+    def get(self, key, default=None):
+        """Returns the value cached for `key` (marking it most recently used), or `default`."""
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _live_entry(self, key):
+        """Returns the entry of `key`, or `None` if there is none or it expired (and is removed)."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.time():
+            del self._entries[key]
+            self._size -= entry[1]
+            self.expirations += 1
+            entry = None
+        return entry
+
+    def put(self, key, value, expires=None):
+        """Caches `value` for `key`, evicting least recently used entries if the cache is full.
+
+        The entry expires at the `expires` timestamp if given, else after the
+        `ttl` of the cache (if any).
+        """
+        size = self.sizeof(value)
+        if expires is None and self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                # a value larger than the whole cache would only flush it
+                return
+            self._entries[key] = (value, size, expires)
+            self._size += size
+            while self._size > self.max_size:
+                (_, (_, evicted_size, _)) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Removes `key` from the cache, returns its value or `default`."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._size -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def entries(self):
+        """Returns a list of the cached (key, value, expires) tuples, least recently used first."""
+        with self._lock:
+            return [(key, entry[0], entry[2]) for (key, entry) in self._entries.items()]
+
+    def stats(self):
+        """Returns the size and the hit, miss and eviction counters of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+            }
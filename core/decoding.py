@@ -0,0 +1,126 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def _bands(values, width, fill):
+    """Returns a [N, L, width] view whose [n, i, k] element is `values[n, i + k]` (`fill` past the end)."""
+    n, length = values.shape
+    padded = np.empty((n, length + width), dtype=values.dtype)
+    padded[:, :length] = values
+    padded[:, length:] = fill
+    row_stride, col_stride = padded.strides
+    return as_strided(padded, shape=(n, length, width), strides=(row_stride, col_stride, col_stride),
+                      writeable=False)
+
+
+def best_spans(start_logits, end_logits, start_mask, end_mask, max_answer_length, n_best_size=1, segments=None):
+    """Finds the best scoring answer spans of a batch of windows.
+
+    The score of a span is the sum of its start and end logits. Only spans that
+    start at a `start_mask` position, end at an `end_mask` position no earlier
+    than their start and are shorter than `max_answer_length` tokens are valid.
+    All the valid spans of the batch are scored at once, in a band of
+    `max_answer_length - 1` end positions following each start position.
+
+    Args:
+      start_logits: float array [N, L] of start logits.
+      end_logits: float array [N, L] of end logits.
+      start_mask: bool array [N, L] of the positions an answer may start at.
+      end_mask: bool array [N, L] of the positions an answer may end at.
+      max_answer_length: spans must be shorter than this many tokens.
+      n_best_size: number of spans returned for each window.
+      segments: optional int array [N, L] of the segment (passage) of each
+        position, spans must start and end in the same segment.
+
+    Returns:
+      A tuple of `start_indexes`, `end_indexes` and `scores` int/int/float
+      arrays [N, n_best_size], best span first, ties by position. Missing spans
+      (windows with less than `n_best_size` valid spans) have a score of
+      `-inf`. When `n_best_size` is larger than the band of spans of a window
+      (`L * min(max_answer_length - 1, L)`), only the band is returned.
+    """
+    start_logits = np.asarray(start_logits, dtype=np.float32)
+    end_logits = np.asarray(end_logits, dtype=np.float32)
+    n, length = start_logits.shape
+    width = max(min(max_answer_length - 1, length), 1)
+
+    # scores[n, i, k] is the score of the span from token i to token i + k
+    scores = start_logits[:, :, None] + _bands(end_logits, width, 0.0)
+    valid = np.asarray(start_mask, dtype=bool)[:, :, None] & _bands(np.asarray(end_mask, dtype=bool), width, False)
+    if segments is not None:
+        segments = np.asarray(segments)
+        valid &= segments[:, :, None] == _bands(segments, width, -1)
+    if max_answer_length <= 1:
+        valid = np.zeros_like(valid)
+    scores = np.where(valid, scores, -np.inf).reshape(n, length * width)
+
+    n_best_size = min(n_best_size, length * width)
+    if n_best_size < length * width:
+        # the spans above the n-th best score, then the earliest of the spans
+        # tied with it, so that ties are broken by position as in a full sort
+        kth = np.partition(scores, -n_best_size, axis=1)[:, -n_best_size, None]
+        above = scores > kth
+        tied = scores == kth
+        ties_needed = n_best_size - above.sum(axis=1, keepdims=True)
+        chosen = above | (tied & (np.cumsum(tied, axis=1) <= ties_needed))
+        best = np.nonzero(chosen)[1].reshape(n, n_best_size)
+    else:
+        best = np.tile(np.arange(length * width), (n, 1))
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    # order by decreasing score, ties by position
+    order = np.lexsort((best, -best_scores), axis=1)
+    best = np.take_along_axis(best, order, axis=1)
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+
+    start_indexes = best // width
+    end_indexes = start_indexes + best % width
+    return start_indexes, end_indexes, best_scores
+
+
+def softmax(scores):
+    """Returns the probabilities of the scores (logits) of a set of spans."""
+    scores = np.asarray(scores, dtype=np.float64)
+    if not len(scores):
+        return scores
+    exp_scores = np.exp(scores - scores.max())
+    return exp_scores / exp_scores.sum()
+
+
+def span_probabilities(start_logits, end_logits, mask, start_indexes, end_indexes):
+    """Returns the probability of a span of each window, given the start and end logits of the window.
+
+    The probability of a span is the probability of its start position times
+    the probability of its end position, over the `mask` positions of the window.
+
+    Args:
+      start_logits: float array [N, L] of start logits.
+      end_logits: float array [N, L] of end logits.
+      mask: bool array [N, L] of the positions of the window (its `input_mask`).
+      start_indexes: int array [N] of the start position of the span of each window.
+      end_indexes: int array [N] of the end position of the span of each window.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    rows = np.arange(len(mask))
+    probabilities = np.ones(len(mask))
+    for (logits, indexes) in [(start_logits, start_indexes), (end_logits, end_indexes)]:
+        logits = np.where(mask, np.asarray(logits, dtype=np.float64), -np.inf)
+        top = logits.max(axis=1, keepdims=True)
+        log_norm = top[:, 0] + np.log(np.exp(logits - top).sum(axis=1))
+        probabilities *= np.exp(logits[rows, indexes] - log_norm)
+    return probabilities
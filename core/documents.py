@@ -0,0 +1,244 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from core.caching import LRUCache
+from core.run_squad import TokenizedContext, doc_token_spans
+
+logger = logging.getLogger()
+
+
+class UnknownDocument(KeyError):
+    """Raised when a `doc_id` is not (or no longer) in the registry."""
+
+    def __str__(self):
+        # a KeyError message is only the quoted key
+        return "Unknown doc_id {}, it may have been evicted, please register the context again with " \
+               "`model/documents`.".format(self.args[0])
+
+
+class DocumentTooLarge(ValueError):
+    """Raised when a document is larger than the registry can keep."""
+
+
+class Document(object):
+    """A registered context, with its tokenization and the time the tokenization took."""
+
+    __slots__ = ("doc_id", "text", "context", "tokenize_seconds")
+
+    def __init__(self, doc_id, text, context, tokenize_seconds):
+        self.doc_id = doc_id
+        self.text = text
+        self.context = context
+        self.tokenize_seconds = tokenize_seconds
+
+
+class DocumentRegistry(object):
+    """Keeps the tokenized contexts uploaded once and then referred to by their `doc_id`.
+
+    The documents are held in a LRU cache bounded in WordPiece tokens. With a
+    `db_file`, they are also saved to a SQLite database (bounded in documents),
+    where the documents evicted from memory, or registered before a restart,
+    are loaded from.
+    """
+
+    def __init__(self, tokenize, tokenizer_key, max_tokens, db_file=None, max_db_documents=10000, update=None):
+        """Constructs a DocumentRegistry.
+
+        Args:
+          tokenize: callable returning the `TokenizedContext` of a context text.
+          tokenizer_key: identifies the tokenizer, the documents saved with
+            another tokenizer are tokenized again.
+          max_tokens: maximum number of WordPiece tokens of the documents kept
+            in memory.
+          db_file: optional SQLite database file the documents are saved to.
+          max_db_documents: maximum number of documents in the database, the
+            least recently used ones are deleted.
+          update: optional callable returning the `TokenizedContext` of an
+            edited text, given the context and the text of its previous version.
+        """
+        self.tokenize = tokenize
+        self.tokenizer_key = tokenizer_key
+        self.max_db_documents = max_db_documents
+        self.update = update
+        self._documents = LRUCache(max_tokens, sizeof=lambda document: max(len(document.context), 1))
+
+        self._stats_lock = threading.Lock()
+        self._references = 0
+        self._unknown = 0
+        self._bytes_saved = 0
+        self._tokenize_seconds_saved = 0.0
+        self._incremental_updates = 0
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_file:
+            self._db = sqlite3.connect(db_file, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, tokenizer_key TEXT, text TEXT, "
+                    "doc_tokens TEXT, token_ids BLOB, tok_to_orig_index BLOB, orig_to_tok_index BLOB, "
+                    "tokenize_seconds REAL, last_used REAL, wordpiece_offsets BLOB)")
+                columns = [row[1] for row in self._db.execute("PRAGMA table_info(documents)")]
+                if "wordpiece_offsets" not in columns:
+                    # a database saved before the character offsets were recorded
+                    self._db.execute("ALTER TABLE documents ADD COLUMN wordpiece_offsets BLOB")
+
+    @staticmethod
+    def doc_id(text):
+        """The `doc_id` of a context text, the same text always gets the same id."""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def add(self, text, base_doc_id=None):
+        """Registers a context, returns its `Document`.
+
+        If `base_doc_id` is the document of a previous version of the text, only
+        the part of the text that was edited is tokenized again.
+
+        Raises:
+          DocumentTooLarge: if the document has more WordPiece tokens than the
+            registry keeps in memory, and there is no database to keep it in.
+        """
+        doc_id = self.doc_id(text)
+        document = self._get(doc_id)
+        if document is not None:
+            return document
+
+        base = self._get(base_doc_id) if base_doc_id is not None and self.update is not None else None
+        started = time.monotonic()
+        if base is not None:
+            context = self.update(base.context, base.text, text)
+            with self._stats_lock:
+                self._incremental_updates += 1
+        else:
+            context = self.tokenize(text)
+        document = Document(doc_id, text, context, time.monotonic() - started)
+        if self._db is None and self._documents.sizeof(document) > self._documents.max_size:
+            # the cache would not keep it, so its doc_id would never resolve
+            raise DocumentTooLarge("The context has {} WordPiece tokens, more than the {} the document registry "
+                                   "keeps.".format(len(context), self._documents.max_size))
+        self._documents.put(doc_id, document)
+        self._save(document)
+        return document
+
+    def resolve(self, doc_id, record=True):
+        """Returns the `Document` a paragraph refers to.
+
+        With `record`, the bytes the client did not send and the tokenization
+        time the reference saved are added to the metrics.
+
+        Raises:
+          UnknownDocument: if there is no such document.
+        """
+        document = self._get(doc_id)
+        if document is None:
+            with self._stats_lock:
+                self._unknown += 1
+            raise UnknownDocument(doc_id)
+        if record:
+            self.record(document)
+        return document
+
+    def record(self, document):
+        """Adds the bytes and the tokenization time a reference to a resolved `Document` saved to the metrics."""
+        with self._stats_lock:
+            self._references += 1
+            self._bytes_saved += len(document.text.encode("utf-8")) - len(document.doc_id)
+            self._tokenize_seconds_saved += document.tokenize_seconds
+
+    def __contains__(self, doc_id):
+        return self._get(doc_id) is not None
+
+    def stats(self):
+        """Returns the size of the registry and what the references to its documents saved."""
+        stats = self._documents.stats()
+        with self._stats_lock:
+            stats.update({
+                'references': self._references,
+                'unknown_references': self._unknown,
+                'bytes_saved': self._bytes_saved,
+                'tokenization_seconds_saved': self._tokenize_seconds_saved,
+                'incremental_updates': self._incremental_updates,
+            })
+        if self._db is not None:
+            with self._db_lock:
+                stats['db_documents'] = self._db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        return stats
+
+    def _get(self, doc_id):
+        document = self._documents.get(doc_id)
+        if document is None and self._db is not None:
+            document = self._load(doc_id)
+            if document is not None:
+                self._documents.put(doc_id, document)
+        return document
+
+    def _load(self, doc_id):
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT tokenizer_key, text, doc_tokens, token_ids, tok_to_orig_index, orig_to_tok_index, "
+                "tokenize_seconds, wordpiece_offsets FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is None:
+                return None
+            with self._db:
+                self._db.execute("UPDATE documents SET last_used = ? WHERE doc_id = ?", (time.time(), doc_id))
+        (tokenizer_key, text, doc_tokens, token_ids, tok_to_orig_index, orig_to_tok_index, tokenize_seconds,
+         wordpiece_offsets) = row
+        if tokenizer_key != self.tokenizer_key or wordpiece_offsets is None:
+            # saved with another vocabulary (or without the character offsets),
+            # the text is all that can be reused
+            started = time.monotonic()
+            document = Document(doc_id, text, self.tokenize(text), time.monotonic() - started)
+            self._save(document)
+            return document
+        context = TokenizedContext(
+            doc_tokens=json.loads(doc_tokens),
+            all_doc_token_ids=np.frombuffer(token_ids, dtype=np.int32),
+            tok_to_orig_index=np.frombuffer(tok_to_orig_index, dtype=np.int32),
+            orig_to_tok_index=np.frombuffer(orig_to_tok_index, dtype=np.int32),
+            doc_token_starts=doc_token_spans(text)[1])
+        (context.wordpiece_starts, context.wordpiece_ends) = np.frombuffer(
+            wordpiece_offsets, dtype=np.int32).reshape(2, -1)
+        return Document(doc_id, text, context, tokenize_seconds)
+
+    def _save(self, document):
+        if self._db is None:
+            return
+        context = document.context
+        try:
+            with self._db_lock, self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO documents (doc_id, tokenizer_key, text, doc_tokens, token_ids, "
+                    "tok_to_orig_index, orig_to_tok_index, tokenize_seconds, last_used, wordpiece_offsets) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (document.doc_id, self.tokenizer_key, document.text, json.dumps(context.doc_tokens),
+                     context.all_doc_token_ids.astype(np.int32).tobytes(),
+                     context.tok_to_orig_index.astype(np.int32).tobytes(),
+                     context.orig_to_tok_index.astype(np.int32).tobytes(), document.tokenize_seconds, time.time(),
+                     np.concatenate([context.wordpiece_starts, context.wordpiece_ends]).astype(np.int32).tobytes()))
+                self._db.execute(
+                    "DELETE FROM documents WHERE doc_id NOT IN "
+                    "(SELECT doc_id FROM documents ORDER BY last_used DESC LIMIT ?)", (self.max_db_documents,))
+        except sqlite3.Error as e:
+            logger.warning('Could not save document {}: {}'.format(document.doc_id, e))
@@ -0,0 +1,170 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import logging
+import threading
+import time
+import uuid
+
+from core.caching import LRUCache
+
+logger = logging.getLogger()
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the maximum number of jobs are waiting to run."""
+
+
+class Job(object):
+    """A question-answering workload run in the background, with its progress and partial answers."""
+
+    def __init__(self, job_id, payload):
+        self.id = job_id
+        self.payload = payload
+        self.status = 'queued'
+        self.created = time.time()
+        self.finished = None
+        self.features_total = None
+        self.features_done = 0
+        self.predictions = []
+        self.error = None
+        self.future = None
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def add_features_done(self, count):
+        with self._lock:
+            self.features_done += count
+
+    def add_paragraph(self):
+        with self._lock:
+            self.predictions.append([])
+
+    def add_answer(self, answer):
+        """Adds the answer of the next question of the current paragraph."""
+        with self._lock:
+            self.predictions[-1].append(answer)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'job_status': self.status,
+                'created': self.created,
+                'finished': self.finished,
+                'features_total': self.features_total,
+                'features_done': self.features_done,
+                'predictions': [list(answers) for answers in self.predictions],
+                'error': self.error,
+            }
+
+
+class JobManager(object):
+    """Runs jobs on a bounded pool of worker threads and keeps the finished ones for a while.
+
+    `run_job` is called with each `Job` on a worker thread. It should fill in the
+    progress and the answers of the job as it goes, and return early once the
+    job is `cancelled`.
+    """
+
+    def __init__(self, run_job, max_workers=2, max_queued=100, retention_count=1000, retention_seconds=3600):
+        """Constructs a JobManager.
+
+        Args:
+          run_job: callable running a `Job`.
+          max_workers: number of jobs run at the same time.
+          max_queued: maximum number of jobs waiting for a worker.
+          retention_count: maximum number of finished jobs kept.
+          retention_seconds: how long a finished job is kept.
+        """
+        self.run_job = run_job
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._active = collections.OrderedDict()
+        self._finished = LRUCache(retention_count, ttl=retention_seconds)
+        self._counts = collections.Counter(submitted=0, done=0, failed=0, cancelled=0)
+
+    def submit(self, payload):
+        """Queues a job for the payload, returns the `Job`."""
+        with self._lock:
+            queued = sum(1 for job in self._active.values() if job.status == 'queued')
+            if queued >= self.max_queued:
+                raise JobQueueFull('{} jobs are already waiting to run'.format(queued))
+            job = Job(uuid.uuid4().hex, payload)
+            self._active[job.id] = job
+            self._counts['submitted'] += 1
+        job.future = self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        """Returns the job, or `None` if there is no such job (or it is no longer retained)."""
+        with self._lock:
+            job = self._active.get(job_id)
+        return job if job is not None else self._finished.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancels the job, returns it or `None` if there is no such job."""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job._cancelled.set()
+        if job.future is not None and job.future.cancel():
+            # the job had not started, it never will
+            self._finish(job, 'cancelled')
+        return job
+
+    def stats(self):
+        """Returns the number of jobs in each state."""
+        with self._lock:
+            statuses = collections.Counter(job.status for job in self._active.values())
+            stats = dict(self._counts)
+        stats['queued'] = statuses['queued']
+        stats['running'] = statuses['running']
+        stats['retained'] = len(self._finished)
+        return stats
+
+    def _run(self, job):
+        with job._lock:
+            job.status = 'running'
+        try:
+            self.run_job(job)
+        except Exception as e:  # the error belongs to the job, not to the worker
+            logger.exception('Job %s failed', job.id)
+            with job._lock:
+                job.error = str(e)
+            self._finish(job, 'failed')
+            return
+        self._finish(job, 'cancelled' if job.cancelled else 'done')
+
+    def _finish(self, job, status):
+        with job._lock:
+            if job.finished is not None:
+                return
+            job.status = status
+            job.finished = time.time()
+            # the payload can be large, only the answers are kept
+            job.payload = None
+        self._finished.put(job.id, job)
+        with self._lock:
+            self._active.pop(job.id, None)
+            self._counts[status] += 1
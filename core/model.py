@@ -19,10 +19,27 @@
 # Licensed under the Apache License, Version 2.0 (the "License").
 
 from maxfw.model import MAXModelWrapper
+import atexit
 import collections
+import hashlib
+import json
 import logging
-from config import DEFAULT_MODEL_PATH, API_DESC, API_TITLE
-from core.run_squad import read_squad_examples, convert_examples_to_features
+import os
+import threading
+import time
+from config import DEFAULT_MODEL_PATH, API_DESC, API_TITLE, PREDICT_BATCH_SIZE, MICRO_BATCHING, \
+    MAX_BATCH_TOKENS, MAX_BATCH_WAIT_MS, SEQ_LENGTH_BUCKETS, CONTEXT_CACHE_MAX_TOKENS, ANSWER_CACHE_MAX_BYTES, \
+    ANSWER_CACHE_TTL, ANSWER_CACHE_FILE, ANSWER_CACHE_SAVE_INTERVAL, WORD_CACHE_SIZE, STREAM_MAX_WINDOWS, \
+    PIPELINING, PIPELINE_QUEUE_SIZE, DOCUMENT_STORE_MAX_TOKENS, DOCUMENT_DB_FILE, DOCUMENT_DB_MAX_DOCUMENTS, \
+    WINDOW_CACHE_MAX_BYTES, ANYTIME_THRESHOLD, ANYTIME_ORDER, RETRIEVAL_TOP_K, RETRIEVAL_PASSAGE_SIZE
+from core.batching import BatchScheduler
+from core.decoding import best_spans, softmax, span_probabilities
+from core.documents import DocumentRegistry
+from core.caching import LRUCache
+from core.pipeline import StageStats, pipelined
+from core.retrieval import PassageIndex
+from core.run_squad import read_squad_examples, iter_squad_examples, convert_examples_to_features, \
+    iter_feature_batches, num_doc_spans, doc_token_spans, tokenize_context, update_context
 from core.tokenization import FullTokenizer, BasicTokenizer
 import tensorflow as tf
 import numpy as np
@@ -31,6 +48,56 @@ import six
 
 logger = logging.getLogger()
 
+# answer of a question, with the index of the window (doc span) it was found in, its
+# `[start_char, end_char)` character offsets in the context when they are known, the
+# n best spans of the question when they were asked for, and the number of windows
+# of the question the anytime mode skipped
+_Prediction = collections.namedtuple(
+    "Prediction", ["question_text", "text", "doc_span_index", "start_char", "end_char", "n_best", "windows_skipped"])
+_Prediction.__new__.__defaults__ = (None, None, None, 0)
+
+# one of the n best spans of a question, with its probability among them
+_Span = collections.namedtuple(
+    "Span", ["text", "probability", "start_logit", "end_logit", "start_char", "end_char"])
+
+# logit of the positions a batch was not padded to with length-bucketed inference
+_PADDING_LOGIT = -10000.0
+
+
+def _model_identity(path):
+    """Identifies a SavedModel by its path and a hash of its graph and variables index."""
+    digest = hashlib.sha256(os.path.abspath(path).encode("utf-8"))
+    for name in ["saved_model.pb", os.path.join("variables", "variables.index")]:
+        file_path = os.path.join(path, name)
+        if os.path.isfile(file_path):
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _prediction_size(prediction):
+    """Approximate memory footprint of a cached prediction, in bytes."""
+    size = 256 + len(prediction.question_text) + len(prediction.text)
+    if prediction.n_best is not None:
+        size += sum(128 + len(span.text) for span in prediction.n_best)
+    return size
+
+
+class _WindowBudget(object):
+    """The number of windows a request may still run through the model, `None` for no limit."""
+
+    def __init__(self, max_windows=None):
+        self.remaining = max_windows
+
+    def take(self, count):
+        """Takes up to `count` windows from the budget, returns how many were taken."""
+        if self.remaining is None:
+            return count
+        count = min(count, self.remaining)
+        self.remaining -= count
+        return count
+
 
 class ModelWrapper(MAXModelWrapper):
 
@@ -52,15 +119,334 @@ class ModelWrapper(MAXModelWrapper):
         self.max_query_length = 64
         self.max_answer_length = 30
 
+        # Number of features sent to the model in a single session run
+        self.batch_size = PREDICT_BATCH_SIZE
+
         # Initialize the tokenizer
         self.tokenizer = FullTokenizer(
-            vocab_file='assets/vocab.txt', do_lower_case=True)
-
-        self.predict_fn = predictor.from_saved_model(DEFAULT_MODEL_PATH)
+            vocab_file='assets/vocab.txt', do_lower_case=True, word_cache_size=WORD_CACHE_SIZE)
+
+        # Tokenized contexts are cached across requests, keyed by the context
+        # text and the tokenizer settings, and bounded in WordPiece tokens
+        self.context_cache = LRUCache(
+            CONTEXT_CACHE_MAX_TOKENS, sizeof=lambda context: max(len(context), 1))
+        vocab_hash = hashlib.sha256("\n".join(self.tokenizer.vocab).encode("utf-8")).hexdigest()
+        self._tokenizer_key = "{}:{}".format(vocab_hash, self.tokenizer.basic_tokenizer.do_lower_case)
+
+        # Contexts uploaded once and then referred to by their `doc_id`
+        self.documents = DocumentRegistry(
+            self._tokenize_text, self._tokenizer_key, DOCUMENT_STORE_MAX_TOKENS, db_file=DOCUMENT_DB_FILE,
+            max_db_documents=DOCUMENT_DB_MAX_DOCUMENTS,
+            update=lambda context, text, new_text: update_context(context, text, new_text, self.tokenizer))
+
+        self.predict_fn = predictor.from_saved_model(path)
+        self.model_id = _model_identity(path)
+
+        # Answers are cached across requests, keyed by the model identity, the
+        # context and the question, so reloading a model invalidates them
+        self.answer_cache = LRUCache(ANSWER_CACHE_MAX_BYTES, sizeof=_prediction_size, ttl=ANSWER_CACHE_TTL)
+        self.answer_cache_file = ANSWER_CACHE_FILE
+
+        # Logits of the windows (doc spans) run through the model, keyed by the
+        # model identity and the tokens of the window, so that after an edit of
+        # a context only the windows whose tokens changed are run again
+        self.window_cache = LRUCache(WINDOW_CACHE_MAX_BYTES, sizeof=lambda logits: 64 + logits[0].nbytes * 2)
+        self._answer_cache_file_lock = threading.Lock()
+        if self.answer_cache_file:
+            self._load_answer_cache()
+            atexit.register(self.save_answer_cache)
+            threading.Thread(target=self._save_answer_cache_periodically, name='answer-cache-saver',
+                             daemon=True).start()
+
+        # A model exported with a dynamic sequence length (see `--export_dynamic_seq_length`
+        # in the training code) only needs each batch padded to the smallest bucket it fits in
+        self.dynamic_seq_length = self.predict_fn.feed_tensors['input_ids'].shape.as_list()[-1] is None
+        self.seq_length_buckets = np.array(sorted(
+            [b for b in SEQ_LENGTH_BUCKETS if b < self.max_seq_length] + [self.max_seq_length]))
+
+        # Queue the features of concurrent requests into shared model batches
+        self.scheduler = None
+        if MICRO_BATCHING:
+            self.scheduler = BatchScheduler(
+                lambda *inputs: self._run_model(*inputs, batch_size=self.batch_size),
+                max_batch_size=self.batch_size, max_batch_tokens=MAX_BATCH_TOKENS, max_wait_ms=MAX_BATCH_WAIT_MS,
+                length_buckets=self.seq_length_buckets if self.dynamic_seq_length else None)
+
+        # Busy time of the stages of the inference pipeline
+        self.stage_stats = collections.OrderedDict(
+            (stage, StageStats()) for stage in ['pre_process', 'predict', 'post_process'])
+
+        # Which window (doc span) of each example held its answer
+        self._window_stats_lock = threading.Lock()
+        self._window_stats = collections.Counter(
+            examples=0, windows=0, answered=0, answered_multi_window=0, won_by_later_window=0, skipped=0)
+        self._winning_windows = collections.Counter()
+
+        # How much of the contexts the passage retriever kept
+        self._retrieval_stats = collections.Counter(
+            questions=0, passages=0, passages_retrieved=0, tokens=0, tokens_retrieved=0)
 
         logger.info('Loaded model')
 
-    def _pre_process(self, inp):
+    def predict(self, x):
+        """Answers the questions of the input, taking the answers given before from the cache."""
+        return collections.OrderedDict(self.predict_iter(x))
+
+    def predict_iter(self, x, progress=None, background=False, answers=None):
+        """Yields the `(question id, prediction)` of every question of the input, in input order.
+
+        The questions that are not in the answer cache are converted, run through
+        the model and answered in chunks of up to `STREAM_MAX_WINDOWS` windows, so
+        the answers of a large request are produced as it is processed, with a
+        bounded number of windows in memory.
+
+        Args:
+          x: the input, with `paragraphs` of `context` and `questions`, and
+            optionally the number of best spans (`n_best`) to return for each
+            question and the `anytime` options (`threshold`, `max_windows` and
+            `order`), which skip the remaining windows of a question once its
+            answer is confident enough, or once `max_windows` windows of the
+            request ran, and the `retrieval` options (`top_k` and
+            `passage_size`), which only run the windows of the passages of the
+            context that best match each question.
+          progress: optional callable, called with the number of features
+            (windows) of each chunk once the chunk is answered.
+          background: whether the features give way to the features of the
+            other requests in the shared model batches.
+          answers: optional dict of the cached answers `count_features` found,
+            which are used in place of the answer cache, so that exactly the
+            questions it counted run through the model.
+        """
+        self._assign_question_ids(x)
+        n_best = x.get("n_best")
+        anytime = x.get("anytime")
+        retrieval = x.get("retrieval")
+        cacheable = self._cacheable(x)
+
+        # the questions whose answers were not yielded yet, in input order, with
+        # their cached answer if they have one
+        pending = collections.deque()
+
+        def missing_paragraphs():
+            # only the questions that are not in the answer cache reach the model
+            for paragraph in x["paragraphs"]:
+                (context_text, document) = self._resolve_paragraph(paragraph)
+                questions = []
+                for qa in paragraph["questions"]:
+                    key = self._answer_key(context_text, qa["question"], n_best, anytime, retrieval) \
+                        if cacheable else None
+                    prediction = None
+                    if key is not None:
+                        prediction = self.answer_cache.get(key) if answers is None else answers.get(key)
+                    pending.append((qa["id"], key, prediction))
+                    if prediction is None:
+                        questions.append(qa)
+                if questions:
+                    yield {"context": context_text, "questions": questions, "document": document}
+
+        # the model answers the missing questions in input order, the cached
+        # answers queued before each of them are yielded first
+        stream = self._predict_stream({"paragraphs": missing_paragraphs()}, progress, background, n_best, anytime,
+                                      retrieval)
+        try:
+            for (_, prediction) in stream:
+                (qas_id, key, cached) = pending.popleft()
+                while cached is not None:
+                    yield qas_id, cached
+                    (qas_id, key, cached) = pending.popleft()
+                if key is not None:
+                    self.answer_cache.put(key, prediction)
+                yield qas_id, prediction
+        finally:
+            # stops the pipeline when the caller stops reading the answers
+            stream.close()
+
+        for (qas_id, _, cached) in pending:
+            yield qas_id, cached
+
+    def _predict_stream(self, x, progress=None, background=False, n_best=None, anytime=None, retrieval=None):
+        """Runs the pre-processing, the model and the post-processing on one chunk of examples at a time.
+
+        With `PIPELINING`, each of them runs in a thread of its own, so the next
+        chunk is tokenized and the previous one decoded while the model runs.
+        """
+        examples = iter_squad_examples(x, context_fn=self._get_context)
+        if retrieval is not None:
+            examples = self._retrieve_passages(examples, retrieval)
+        if anytime is None:
+            stages = [
+                lambda features: self._predict((features, features.examples), background=background),
+                # the features of the chunk are released once it is decoded
+                lambda result: (result[1][1], self._decode(result, n_best), len(result[1][0]))]
+        else:
+            budget = _WindowBudget(anytime.get("max_windows"))
+            stages = [
+                lambda features: self._predict_anytime(features, anytime, budget, background=background),
+                lambda result: (result[0][1][1], self._decode(result[0], n_best, windows_run=result[1]),
+                                len(result[1]))]
+        chunks = pipelined(
+            iter_feature_batches(examples, self.tokenizer, self.max_seq_length, self.doc_stride,
+                                 self.max_query_length, max_features=STREAM_MAX_WINDOWS),
+            stages, list(self.stage_stats.values()), queue_size=PIPELINE_QUEUE_SIZE, threaded=PIPELINING)
+        try:
+            for (chunk_examples, predictions, num_features) in chunks:
+                if progress is not None:
+                    progress(num_features)
+                for (example, prediction) in zip(chunk_examples, predictions):
+                    yield example.qas_id, prediction
+        finally:
+            chunks.close()
+
+    def count_features(self, x, answers=None):
+        """Returns the number of features (windows) `predict_iter` runs through the model for the input.
+
+        The questions that are in the answer cache do not count. The contexts are
+        tokenized (and cached) to count the windows. Given an `answers` dict, the
+        cached answers are added to it by their key, passing it on to
+        `predict_iter` keeps an answer that expires (or is evicted) in between
+        from running through the model uncounted.
+        """
+        retrieval = x.get("retrieval")
+        cacheable = self._cacheable(x)
+        count = 0
+        for paragraph in x["paragraphs"]:
+            (context_text, document) = self._resolve_paragraph(paragraph, record=False)
+            context = None
+            for qa in paragraph["questions"]:
+                question = qa["question"] if isinstance(qa, dict) else qa
+                if cacheable:
+                    key = self._answer_key(context_text, question, x.get("n_best"), x.get("anytime"), retrieval)
+                    prediction = self.answer_cache.get(key)
+                    if prediction is not None:
+                        if answers is not None:
+                            answers[key] = prediction
+                        continue
+                if context is None:
+                    context = self._get_context({"context": context_text, "document": document})
+                    if retrieval is not None:
+                        index = PassageIndex(context, retrieval.get("passage_size", RETRIEVAL_PASSAGE_SIZE))
+                        sub_contexts = {}
+                _, query_ids = self.tokenizer.tokenize_to_ids(question)
+                question_context = context
+                if retrieval is not None:
+                    question_context = self._retrieved_context(index, query_ids, retrieval, sub_contexts)
+                # The -3 accounts for [CLS], [SEP] and [SEP]
+                max_tokens_for_doc = self.max_seq_length - min(len(query_ids), self.max_query_length) - 3
+                count += num_doc_spans(len(question_context), max_tokens_for_doc, self.doc_stride)
+        return count
+
+    def _retrieve_passages(self, examples, options):
+        """Yields the examples with their context narrowed down to the passages that best match their question.
+
+        The passage index of a context is built once for all the questions asked
+        about it, and the questions that retrieve the same passages share their
+        narrowed context.
+        """
+        index = None
+        for example in examples:
+            if index is None or example.context is not index.context:
+                index = PassageIndex(example.context, options.get("passage_size", RETRIEVAL_PASSAGE_SIZE))
+                sub_contexts = {}
+            _, query_ids = self.tokenizer.tokenize_to_ids(example.question_text)
+            example.context = self._retrieved_context(index, query_ids, options, sub_contexts)
+            # the windows of an example are laid out once per distinct `doc_tokens`
+            example.doc_tokens = example.context.doc_tokens
+            with self._window_stats_lock:
+                self._retrieval_stats['questions'] += 1
+                self._retrieval_stats['passages'] += len(index)
+                self._retrieval_stats['passages_retrieved'] += min(options.get("top_k", RETRIEVAL_TOP_K), len(index))
+                self._retrieval_stats['tokens'] += len(index.context)
+                self._retrieval_stats['tokens_retrieved'] += len(example.context)
+            yield example
+
+    def _retrieved_context(self, index, query_ids, options, sub_contexts):
+        """Returns the context of the `top_k` passages of the index that best match the WordPiece ids of a question."""
+        passages = tuple(index.top_k(query_ids[:self.max_query_length], options.get("top_k", RETRIEVAL_TOP_K)))
+        if passages not in sub_contexts:
+            sub_contexts[passages] = index.sub_context(passages)
+        return sub_contexts[passages]
+
+    @staticmethod
+    def _cacheable(x):
+        """Whether the answers of the input go through the answer cache.
+
+        The window budget of `max_windows` is shared by the whole request, so the
+        answers it cut short depend on the other questions and are not cached.
+        """
+        anytime = x.get("anytime")
+        return anytime is None or anytime.get("max_windows") is None
+
+    def _resolve_paragraph(self, paragraph, record=True):
+        """Returns the context text of a paragraph and the registered `Document` it refers to, if any.
+
+        A `Document` already resolved (and recorded) when the input was validated
+        is used as is, so it cannot be evicted in between.
+        """
+        if paragraph.get("document") is not None:
+            document = paragraph["document"]
+            if record:
+                self.documents.record(document)
+            return document.text, document
+        if paragraph.get("doc_id") is not None:
+            document = self.documents.resolve(paragraph["doc_id"], record=record)
+            return document.text, document
+        return paragraph["context"], None
+
+    def _answer_key(self, context, question, n_best=None, anytime=None, retrieval=None):
+        key = "{}\n{}\n{}\n{}".format(self.model_id, self._tokenizer_key, context, question)
+        if n_best is not None:
+            # the n best spans are only kept in the answers asked for with them
+            key += "\nn_best={}".format(n_best)
+        if anytime is not None:
+            # the answers of the anytime mode may come from some of the windows only
+            key += "\nanytime={}".format(json.dumps(anytime, sort_keys=True))
+        if retrieval is not None:
+            # the answers found with retrieval only come from some of the passages
+            key += "\nretrieval={}".format(json.dumps(retrieval, sort_keys=True))
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _load_answer_cache(self):
+        """Loads the answers the current model gave before the last restart."""
+        if not os.path.isfile(self.answer_cache_file):
+            return
+        try:
+            with open(self.answer_cache_file, "r") as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warning('Could not load the answer cache from {}: {}'.format(self.answer_cache_file, e))
+            return
+        if data.get("model_id") != self.model_id:
+            logger.info('Ignoring the answer cache of another model in {}'.format(self.answer_cache_file))
+            return
+        now = time.time()
+        for (key, expires, prediction) in data["entries"]:
+            if expires is None or expires > now:
+                prediction = _Prediction(*prediction)
+                if prediction.n_best is not None:
+                    prediction = prediction._replace(n_best=[_Span(*span) for span in prediction.n_best])
+                self.answer_cache.put(key, prediction, expires=expires)
+        logger.info('Loaded {} cached answers'.format(len(self.answer_cache)))
+
+    def save_answer_cache(self):
+        """Saves the answer cache to `ANSWER_CACHE_FILE`, so that it survives restarts."""
+        if not self.answer_cache_file:
+            return
+        entries = [[key, expires, list(prediction)] for (key, prediction, expires) in self.answer_cache.entries()]
+        with self._answer_cache_file_lock:
+            tmp_file = self.answer_cache_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"model_id": self.model_id, "entries": entries}, f)
+            os.replace(tmp_file, self.answer_cache_file)
+
+    def _save_answer_cache_periodically(self):
+        while True:
+            time.sleep(ANSWER_CACHE_SAVE_INTERVAL)
+            try:
+                self.save_answer_cache()
+            except (IOError, OSError) as e:
+                logger.warning('Could not save the answer cache to {}: {}'.format(self.answer_cache_file, e))
+
+    def _assign_question_ids(self, inp):
         # if question ids are not included, generate them
         # Note: this may not work if the input data only has question ids for some of the questions
         unique_id = 1
@@ -76,146 +462,364 @@ class ModelWrapper(MAXModelWrapper):
                     article["questions"][i] = new_question
                     unique_id += 1
 
+    def _pre_process(self, inp):
+        self._assign_question_ids(inp)
+
         # convert answers to input features
-        predict_examples = read_squad_examples(inp)
+        predict_examples = read_squad_examples(inp, context_fn=self._get_context)
         features = convert_examples_to_features(predict_examples,
                                                 self.tokenizer, self.max_seq_length,
                                                 self.doc_stride, self.max_query_length)
 
         return features, predict_examples
 
+    def _get_context(self, paragraph):
+        """Returns the tokenized context of a paragraph, from the document registry or the cache if it was tokenized before."""
+        if paragraph.get("document") is not None:
+            return paragraph["document"].context
+        if paragraph.get("doc_id") is not None:
+            return self.documents.resolve(paragraph["doc_id"], record=False).context
+
+        paragraph_text = paragraph["context"]
+        key = hashlib.sha256(
+            "{}\n{}".format(self._tokenizer_key, paragraph_text).encode("utf-8")).hexdigest()
+        context = self.context_cache.get(key)
+        if context is None:
+            context = self._tokenize_text(paragraph_text)
+            self.context_cache.put(key, context)
+        return context
+
+    def _tokenize_text(self, paragraph_text):
+        doc_tokens, doc_token_starts = doc_token_spans(paragraph_text)
+        return tokenize_context(doc_tokens, self.tokenizer, doc_token_starts=doc_token_starts)
+
     def _post_process(self, result):
         # convert to text predictions
-        all_results = result[0]
-        all_features = result[1][0]
-        predict_examples = result[1][1]
-
-        example_index_to_features = collections.defaultdict(list)
-        for feature in all_features:
-            example_index_to_features[feature.example_index].append(feature)
-
-        unique_id_to_result = {}
-        for result in all_results:
-            unique_id_to_result[result.unique_id] = result
-
-        _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "PrelimPrediction",
-            ["feature_index", "start_index", "end_index", "start_logit", "end_logit"])
-
         all_predictions = collections.OrderedDict()
-
-        for (example_index, example) in enumerate(predict_examples):
-            features = example_index_to_features[example_index]
-            prelim_preds = []
-            feature = features[0]
-            result = unique_id_to_result[feature.unique_id]
-            start_indices = self._get_best_indices(result.start_logits, 10)
-            end_indices = self._get_best_indices(result.end_logits, 10)
-
-            # We could hypothetically create invalid predictions, e.g., predict
-            # that the start of the span is in the question. We throw out all
-            # invalid predictions within the 10 best predictions.
-            for start_index in start_indices:
-                for end_index in end_indices:
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length >= self.max_answer_length:
-                        continue
-                    prelim_preds.append(_PrelimPrediction(
-                        feature_index=0,
-                        start_index=start_index,
-                        end_index=end_index,
-                        start_logit=result.start_logits[start_index],
-                        end_logit=result.end_logits[end_index]))
-
-            # use best prediction
-            pred = None
-            if len(prelim_preds) == 0:
-                pred = _PrelimPrediction(
-                    feature_index=0,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=0,
-                    end_logit=0)
-            else:
-                pred = prelim_preds[0]
-
-            final_text = ""
-            feature = features[pred.feature_index]
-            if pred.start_index > 0:  # this is a non-null prediction
-                tok_tokens = feature.tokens[
-                    pred.start_index:(pred.end_index + 1)]
-                orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                orig_doc_end = feature.token_to_orig_map[pred.end_index]
-                orig_tokens = example.doc_tokens[
-                    orig_doc_start:(orig_doc_end + 1)]
-                tok_text = " ".join(tok_tokens)
-
-                # De-tokenize WordPieces that have been split off.
-                tok_text = tok_text.replace(" ##", "")
-                tok_text = tok_text.replace("##", "")
-
-                # Clean whitespace
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-                final_text = self.get_final_text(tok_text, orig_text, True)
-
-            all_predictions[example.qas_id] = (example.question_text, final_text)
-
+        for (example, prediction) in zip(result[1][1], self._decode(result)):
+            all_predictions[example.qas_id] = prediction
         return all_predictions
 
-    def _predict(self, x, batch_size=32):
-        features = x[0]
+    def _decode(self, result, n_best=None, windows_run=None):
+        """Returns the prediction of every example, in example order.
+
+        With `n_best`, each prediction also holds the `n_best` best spans of its
+        example (with distinct texts), best first, with their probability among
+        these spans. `windows_run` is the bool array of the windows the
+        anytime mode ran, the others are counted in `windows_skipped`.
+        """
+        start_logits, end_logits = result[0]
+        features = result[1][0]
+        predict_examples = result[1][1]
+        n_best_size = 1 if n_best is None else n_best
+
+        # decode the `n_best` best spans of every window (doc span) in one pass,
+        # then rank the spans of all the windows of each example. A token can
+        # only start an answer in the window that gives it its maximum context,
+        # and ties between windows go to the earliest window.
+        example_to_spans = collections.defaultdict(list)
+        if len(features):
+            start_indexes, end_indexes, scores = best_spans(
+                start_logits, end_logits, features.start_mask, features.end_mask, self.max_answer_length,
+                n_best_size=n_best_size, segments=self._passage_segments(features))
+            rows = np.repeat(np.arange(len(features)), scores.shape[1])
+            (start_indexes, end_indexes, scores) = (start_indexes.ravel(), end_indexes.ravel(), scores.ravel())
+            order = np.lexsort((np.arange(len(scores)), -scores, features.example_index[rows]))
+            for i in order:
+                # examples without any valid span get an empty answer
+                if np.isfinite(scores[i]):
+                    example_to_spans[features.example_index[rows[i]]].append(
+                        (scores[i], rows[i], start_indexes[i], end_indexes[i]))
+        self._record_windows(features, {example_index: spans[0] for (example_index, spans) in example_to_spans.items()},
+                             windows_run)
+        windows_skipped = np.zeros(len(predict_examples), dtype=np.int64)
+        if windows_run is not None:
+            windows_skipped = np.bincount(features.example_index[~windows_run], minlength=len(predict_examples))
 
         predictions = []
-        for i in range(0, len(features)):
+        for (example_index, example) in enumerate(predict_examples):
+            spans = []
+            seen_texts = set()
+            doc_span_index = None
+            for (_, row, start_index, end_index) in example_to_spans.get(example_index, []):
+                # positions in the window map to WordPiece tokens of the context
+                tok_start = features.doc_start[row] + start_index - features.doc_offset[row]
+                tok_end = features.doc_start[row] + end_index - features.doc_offset[row]
+                (text, start_char, end_char) = self._span_answer(example, tok_start, tok_end)
+                if text in seen_texts:
+                    continue
+                seen_texts.add(text)
+                if not spans:
+                    doc_span_index = int(features.doc_span_index[row])
+                spans.append(_Span(text, None, float(start_logits[row, start_index]),
+                                   float(end_logits[row, end_index]), start_char, end_char))
+                if len(spans) == n_best_size:
+                    break
+
+            if not spans:
+                predictions.append(_Prediction(
+                    example.question_text, "", None, windows_skipped=int(windows_skipped[example_index])))
+                continue
+            best = spans[0]
+            n_best_spans = None
+            if n_best is not None:
+                probabilities = softmax(np.array([span.start_logit + span.end_logit for span in spans]))
+                n_best_spans = [span._replace(probability=float(p)) for (span, p) in zip(spans, probabilities)]
+            predictions.append(_Prediction(
+                example.question_text, best.text, doc_span_index, best.start_char, best.end_char, n_best_spans,
+                int(windows_skipped[example_index])))
+
+        return predictions
+
+    @staticmethod
+    def _passage_segments(features):
+        """Returns the passage id of each position of the features, or `None` if no context is made of passages.
+
+        The positions outside of the doc tokens are masked out of the answers,
+        their passage id is -1.
+        """
+        if all(example.context.passage_ids is None for example in features.examples):
+            return None
+        segments = np.full(features.input_ids.shape, -1, dtype=np.int32)
+        for row in range(len(features)):
+            passage_ids = features.examples[features.example_index[row]].context.passage_ids
+            if passage_ids is None:
+                continue
+            (doc_offset, doc_start) = (features.doc_offset[row], features.doc_start[row])
+            doc_length = features.doc_length[row]
+            segments[row, doc_offset:doc_offset + doc_length] = passage_ids[doc_start:doc_start + doc_length]
+        return segments
+
+    def _span_answer(self, example, tok_start, tok_end):
+        """Returns the text of the span of WordPiece tokens of an example, with its character offsets if they are known."""
+        context = example.context
+        if context.wordpiece_starts is not None:
+            # the answer is the characters its WordPiece tokens come from
+            start_char = int(context.wordpiece_starts[tok_start])
+            end_char = int(context.wordpiece_ends[tok_end])
+            return self._span_text(context, tok_start, tok_end, start_char, end_char), start_char, end_char
+
+        # only the WordPiece strings of the answer are rebuilt from their ids
+        tok_tokens = self.tokenizer.convert_ids_to_tokens(context.all_doc_token_ids[tok_start:(tok_end + 1)])
+        orig_doc_start = context.tok_to_orig_index[tok_start]
+        orig_doc_end = context.tok_to_orig_index[tok_end]
+        orig_tokens = example.doc_tokens[
+            orig_doc_start:(orig_doc_end + 1)]
+        tok_text = " ".join(tok_tokens)
+
+        # De-tokenize WordPieces that have been split off.
+        tok_text = tok_text.replace(" ##", "")
+        tok_text = tok_text.replace("##", "")
+
+        # Clean whitespace
+        tok_text = tok_text.strip()
+        tok_text = " ".join(tok_text.split())
+        orig_text = " ".join(orig_tokens)
+        return self.get_final_text(tok_text, orig_text, True), None, None
+
+    @staticmethod
+    def _span_text(context, tok_start, tok_end, start_char, end_char):
+        """The text of the `[start_char, end_char)` span of a context, with its whitespace runs made single spaces."""
+        orig_doc_start = context.tok_to_orig_index[tok_start]
+        orig_doc_end = context.tok_to_orig_index[tok_end]
+        tokens = context.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
+        tokens[-1] = tokens[-1][:end_char - context.doc_token_starts[orig_doc_end]]
+        tokens[0] = tokens[0][start_char - context.doc_token_starts[orig_doc_start]:]
+        return " ".join(tokens)
+
+    def _record_windows(self, features, example_to_span, windows_run=None):
+        """Count the windows of each example, which of them held the answer and which were skipped."""
+        windows = np.bincount(features.example_index, minlength=len(features.examples))
+        with self._window_stats_lock:
+            self._window_stats['examples'] += int(np.count_nonzero(windows))
+            self._window_stats['windows'] += len(features)
+            if windows_run is not None:
+                self._window_stats['skipped'] += len(features) - int(np.count_nonzero(windows_run))
+            for (example_index, (_, row, _, _)) in six.iteritems(example_to_span):
+                doc_span_index = int(features.doc_span_index[row])
+                self._window_stats['answered'] += 1
+                if windows[example_index] > 1:
+                    self._window_stats['answered_multi_window'] += 1
+                    if doc_span_index > 0:
+                        self._window_stats['won_by_later_window'] += 1
+                self._winning_windows[doc_span_index] += 1
+
+    def _predict(self, x, batch_size=None, background=False):
+        features = x[0]
+        return self._logits(features.input_ids, features.input_mask, features.segment_ids, batch_size, background), x
+
+    def _predict_anytime(self, features, options, budget, background=False):
+        """Runs the windows of a chunk through the model in rounds, until the answer of each question is confident enough.
+
+        Each round runs the next window (in the `order` of the options) of every
+        question whose best span so far has a probability below the `threshold`
+        of the options, within the windows left in the `budget` of the request.
+        The windows that were not run are masked out of the decoding.
+
+        Returns the logits and the features, as `_predict` does, and a bool
+        array [N] of the windows that were run.
+        """
+        threshold = options.get("threshold", ANYTIME_THRESHOLD)
+        start_logits = np.full(features.input_ids.shape, _PADDING_LOGIT, dtype=np.float32)
+        end_logits = np.full(features.input_ids.shape, _PADDING_LOGIT, dtype=np.float32)
+        ran = np.zeros(len(features), dtype=bool)
+
+        # the windows of each example, in the order they are run
+        queues = collections.OrderedDict()
+        for row in self._window_order(features, options.get("order", ANYTIME_ORDER)):
+            queues.setdefault(features.example_index[row], collections.deque()).append(row)
+        best_scores = collections.defaultdict(lambda: -np.inf)
+        segments = self._passage_segments(features)
+
+        while queues:
+            count = budget.take(len(queues))
+            if not count:
+                break
+            rows = np.array([windows.popleft() for windows in list(queues.values())[:count]], dtype=np.int64)
+            (start_logits[rows], end_logits[rows]) = self._logits(
+                features.input_ids[rows], features.input_mask[rows], features.segment_ids[rows],
+                background=background)
+            ran[rows] = True
+
+            (start_indexes, end_indexes, scores) = best_spans(
+                start_logits[rows], end_logits[rows], features.start_mask[rows], features.end_mask[rows],
+                self.max_answer_length, segments=None if segments is None else segments[rows])
+            probabilities = span_probabilities(start_logits[rows], end_logits[rows], features.input_mask[rows],
+                                               start_indexes[:, 0], end_indexes[:, 0])
+            for (row, score, probability) in zip(rows, scores[:, 0], probabilities):
+                example_index = features.example_index[row]
+                # an example stops once the best span of all its windows run so far is confident enough
+                if score > best_scores[example_index]:
+                    best_scores[example_index] = score
+                    if probability >= threshold:
+                        queues.pop(example_index, None)
+                        continue
+                if example_index in queues and not queues[example_index]:
+                    del queues[example_index]
+
+        features.start_mask &= ran[:, None]
+        features.end_mask &= ran[:, None]
+        return ((start_logits, end_logits), (features, features.examples)), ran
+
+    def _window_order(self, features, order):
+        """Returns the rows of the features grouped by example, the windows of each example in the order they are run.
+
+        With the `overlap` order, the windows of an example are ranked by the number
+        of distinct question tokens in their doc tokens, otherwise in document order.
+        """
+        if order == "overlap":
+            overlap = np.array([
+                len(np.intersect1d(features.input_ids[row, 1:features.doc_offset[row] - 1],
+                                   features.input_ids[row, features.doc_offset[row]:
+                                                      features.doc_offset[row] + features.doc_length[row]]))
+                for row in range(len(features))], dtype=np.int64)
+            # the most overlapping windows first, ties in document order
+            return np.lexsort((features.doc_span_index, -overlap, features.example_index))
+        return np.lexsort((features.doc_span_index, features.example_index))
+
+    def _logits(self, input_ids, input_mask, segment_ids, batch_size=None, background=False):
+        """Returns the start and end logits of the windows, taking the windows run before from the window cache."""
+        if self.window_cache.max_size <= 0:
+            # the feature matrices are fed to the model as they are
+            return self._run_windows(input_ids, input_mask, segment_ids, batch_size, background)
+
+        lengths = input_mask.sum(axis=1)
+        keys = [self._window_key(input_ids, segment_ids, row, length) for (row, length) in enumerate(lengths)]
+        cached = [self.window_cache.get(key) for key in keys]
+        missing = np.array([row for (row, logits) in enumerate(cached) if logits is None], dtype=np.int64)
+
+        if len(missing) == len(keys):
+            start_logits, end_logits = self._run_windows(input_ids, input_mask, segment_ids, batch_size, background)
+        else:
+            # only the rows of the windows not seen before are copied and run through the model
+            start_logits = np.full(input_ids.shape, _PADDING_LOGIT, dtype=np.float32)
+            end_logits = np.full(input_ids.shape, _PADDING_LOGIT, dtype=np.float32)
+            if len(missing):
+                (start_logits[missing], end_logits[missing]) = self._run_windows(
+                    input_ids[missing], input_mask[missing], segment_ids[missing], batch_size, background)
+            for (row, logits) in enumerate(cached):
+                if logits is not None:
+                    start_logits[row, :lengths[row]] = logits[0]
+                    end_logits[row, :lengths[row]] = logits[1]
+
+        for row in missing:
+            length = lengths[row]
+            self.window_cache.put(keys[row], (start_logits[row, :length].copy(), end_logits[row, :length].copy()))
+        return start_logits, end_logits
+
+    def _window_key(self, input_ids, segment_ids, row, length):
+        digest = hashlib.sha256(self.model_id.encode("utf-8"))
+        digest.update(input_ids[row, :length].tobytes())
+        digest.update(segment_ids[row, :length].tobytes())
+        return digest.hexdigest()
+
+    def _run_windows(self, input_ids, input_mask, segment_ids, batch_size=None, background=False):
+        if batch_size is None and self.scheduler is not None:
+            # share the model batches with the other in-flight requests
+            return self.scheduler.submit(input_ids, input_mask, segment_ids, background=background).result()
+        return self._run_model(input_ids, input_mask, segment_ids, batch_size=batch_size)
+
+    def _run_model(self, input_ids, input_mask, segment_ids, batch_size=None):
+        """Run the rows of the input matrices through the model, `batch_size` rows per session run."""
+        if batch_size is None:
+            batch_size = self.batch_size
+
+        # positions a batch was not padded to get a logit no span can compete with
+        start_logits = np.full(input_ids.shape, _PADDING_LOGIT, dtype=np.float32)
+        end_logits = np.full(input_ids.shape, _PADDING_LOGIT, dtype=np.float32)
+
+        # sort the rows by length so each batch holds rows of similar length,
+        # the logits are written back to the original row order below. With
+        # `MICRO_BATCHING`, the scheduler already grouped the rows of the batch
+        # by length bucket, across all the queued requests
+        lengths = input_mask.sum(axis=1)
+        order = np.argsort(lengths, kind='mergesort') if self.dynamic_seq_length else np.arange(len(input_ids))
+
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            seq_length = input_ids.shape[1]
+            # without sorting, the rows of a batch are a slice of the inputs,
+            # which the model is fed without copying them
+            batch_rows = slice(start, start + len(rows))
+            if self.dynamic_seq_length:
+                batch_rows = rows
+                bucket = np.searchsorted(self.seq_length_buckets, lengths[rows].max())
+                seq_length = min(self.seq_length_buckets[bucket], seq_length)
+
+            # the serving signature accepts a `None` batch dimension, so all the
+            # rows of the batch go through the model in one session run
             result = self.predict_fn({
-                "unique_ids": np.array(features[i].unique_id).reshape(1),
-                "input_ids": np.array(features[i].input_ids).reshape(-1, self.max_seq_length),
-                "input_mask": np.array(features[i].input_mask).reshape(-1, self.max_seq_length),
-                "segment_ids": np.array(features[i].segment_ids).reshape(-1, self.max_seq_length)
+                "unique_ids": rows.astype(np.int32),
+                "input_ids": input_ids[batch_rows, :seq_length],
+                "input_mask": input_mask[batch_rows, :seq_length],
+                "segment_ids": segment_ids[batch_rows, :seq_length]
             })
 
-            predictions.append(result)
-
-        RawResult = collections.namedtuple("RawResult", ["unique_id", "start_logits", "end_logits"])
-
-        all_results = []
-        for result in predictions:
-            unique_id = int(result["unique_ids"])
-            start_logits = [float(x) for x in result["start_logits"].flat]
-            end_logits = [float(x) for x in result["end_logits"].flat]
-            all_results.append(
-                RawResult(
-                    unique_id=unique_id,
-                    start_logits=start_logits,
-                    end_logits=end_logits))
-
-        return all_results, x
-
-    def _get_best_indices(self, logits, n_best_size):
-        """Get the best logits from a list."""
-        index_and_score = sorted(
-            enumerate(logits), key=lambda x: x[1], reverse=True)
-
-        best_indexes = []
-        for i in range(len(index_and_score)):
-            if i >= n_best_size:
-                break
-            best_indexes.append(index_and_score[i][0])
-        return best_indexes
+            # the model echoes `unique_ids` back, use them to map each row of
+            # logits to its feature instead of relying on the output order
+            rows = result["unique_ids"].reshape(-1)
+            start_logits[rows, :seq_length] = result["start_logits"]
+            end_logits[rows, :seq_length] = result["end_logits"]
+
+        return start_logits, end_logits
+
+    def metrics(self):
+        """Runtime metrics of the inference pipeline."""
+        with self._window_stats_lock:
+            windows = dict(self._window_stats)
+            windows['winning_window_histogram'] = {str(k): v for (k, v) in sorted(self._winning_windows.items())}
+            retrieval = dict(self._retrieval_stats)
+        return {
+            'batching': self.scheduler.stats() if self.scheduler is not None else {},
+            'windows': windows,
+            'retrieval': retrieval,
+            'pipeline': {stage: stats.stats() for (stage, stats) in six.iteritems(self.stage_stats)},
+            'word_cache': self.tokenizer.word_cache.stats() if self.tokenizer.word_cache is not None else {},
+            'context_cache': self.context_cache.stats(),
+            'answer_cache': self.answer_cache.stats(),
+            'window_cache': self.window_cache.stats(),
+            'documents': self.documents.stats()
+        }
 
     def get_final_text(self, pred_text, orig_text, do_lower_case):
         """Project the tokenized prediction back to the original text."""
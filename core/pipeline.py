@@ -0,0 +1,169 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import queue
+import threading
+import time
+
+# how often a blocked stage checks whether the pipeline was closed
+_POLL_SECONDS = 0.1
+
+# marks the end of the items of a queue
+_DONE = object()
+
+
+class _Failure(object):
+    """An error raised by a stage, passed down the queues to the consumer."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class StageStats(object):
+    """Counts the items a pipeline stage processed and the time it was busy with them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._items = 0
+        self._busy = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self._items += 1
+            self._busy += seconds
+
+    def stats(self):
+        """Returns the item count and the busy time of the stage.
+
+        The utilization is the busy time over the time since the stats were
+        created, it is the mean number of busy workers and can exceed 1 when
+        concurrent requests run the stage at the same time.
+        """
+        with self._lock:
+            elapsed = max(time.monotonic() - self._started, 1e-9)
+            return {
+                'items': self._items,
+                'busy_seconds': self._busy,
+                'mean_ms': 1000.0 * self._busy / max(self._items, 1),
+                'utilization': self._busy / elapsed,
+            }
+
+
+def pipelined(source, stages, stats, queue_size=2, threaded=True):
+    """Yields the results of passing every item of `source` through the `stages` functions, in order.
+
+    Args:
+      source: iterable of the items to process, its iteration is the first stage.
+      stages: functions applied to each item, one after the other.
+      stats: the `StageStats` of the source, then of each stage.
+      queue_size: number of items a stage may get ahead of the next one.
+      threaded: whether the source and each stage run in a thread of their own,
+        so that consecutive items go through different stages at the same time.
+        Otherwise every item goes through all the stages on the calling thread.
+
+    Closing the generator stops the threads of the pipeline.
+    """
+    if not threaded:
+        for item in _timed_iter(source, stats[0]):
+            for (stage, stage_stats) in zip(stages, stats[1:]):
+                started = time.monotonic()
+                item = stage(item)
+                stage_stats.record(time.monotonic() - started)
+            yield item
+        return
+
+    stop = threading.Event()
+    queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=_feed, args=(source, queues[0], stats[0], stop), name='pipeline-source')]
+    for (i, stage) in enumerate(stages):
+        threads.append(threading.Thread(target=_work, args=(stage, queues[i], queues[i + 1], stats[i + 1], stop),
+                                        name='pipeline-stage-{}'.format(i + 1)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+
+def _timed_iter(items, stats):
+    items = iter(items)
+    while True:
+        started = time.monotonic()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        stats.record(time.monotonic() - started)
+        yield item
+
+
+def _put(items, item, stop):
+    """Puts an item in a bounded queue, gives up if the pipeline is closed."""
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(items, stop):
+    """Takes an item from a queue, returns `_DONE` if the pipeline is closed."""
+    while not stop.is_set():
+        try:
+            return items.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def _feed(source, output, stats, stop):
+    try:
+        for item in _timed_iter(source, stats):
+            if not _put(output, item, stop):
+                return
+    except Exception as e:  # the error belongs to the consumer, not to the thread
+        _put(output, _Failure(e), stop)
+        return
+    _put(output, _DONE, stop)
+
+
+def _work(stage, items, output, stats, stop):
+    while True:
+        item = _get(items, stop)
+        if item is _DONE or isinstance(item, _Failure):
+            _put(output, item, stop)
+            return
+        started = time.monotonic()
+        try:
+            item = stage(item)
+        except Exception as e:  # the error belongs to the consumer, not to the thread
+            _put(output, _Failure(e), stop)
+            return
+        stats.record(time.monotonic() - started)
+        if not _put(output, item, stop):
+            return
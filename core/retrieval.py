@@ -0,0 +1,159 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import re
+
+import numpy as np
+
+from core.run_squad import TokenizedContext
+
+# a whitespace token ending a sentence, possibly followed by closing quotes or brackets
+_SENTENCE_END_RE = re.compile(r"[.!?][\"')\]’”]*$")
+
+
+def sentence_passages(context, passage_size):
+    """Splits a tokenized context into passages of whole sentences, of up to `passage_size` WordPiece tokens.
+
+    A passage ends at the last sentence end that keeps it within `passage_size`
+    tokens, or at a whitespace token when a single sentence is longer than that.
+
+    Returns:
+      The `[start, stop)` whitespace token ranges of the passages, as two int arrays.
+    """
+    num_tokens = len(context.doc_tokens)
+    piece_counts = np.diff(np.append(context.orig_to_tok_index, len(context)))
+    starts = []
+    stops = []
+    start = 0
+    size = 0
+    sentence_end = None
+    for i in range(num_tokens):
+        count = int(piece_counts[i])
+        while size + count > passage_size and i > start:
+            stop = sentence_end if sentence_end is not None and sentence_end > start else i
+            starts.append(start)
+            stops.append(stop)
+            start = stop
+            size = int(piece_counts[start:i].sum())
+            sentence_end = None
+        size += count
+        if _SENTENCE_END_RE.search(context.doc_tokens[i]):
+            sentence_end = i + 1
+    if start < num_tokens:
+        starts.append(start)
+        stops.append(num_tokens)
+    return np.array(starts, dtype=np.int64), np.array(stops, dtype=np.int64)
+
+
+class PassageIndex(object):
+    """A BM25 index of the sentence-aligned passages of a tokenized context.
+
+    The terms are the WordPiece ids of the context. The index is a sparse
+    passage-term matrix held as arrays of its non-zero entries, sorted by term,
+    with the BM25 weight of each entry, so scoring a question only gathers the
+    entries of its terms and sums them by passage.
+    """
+
+    def __init__(self, context, passage_size, k1=1.2, b=0.75):
+        """Constructs a PassageIndex.
+
+        Args:
+          context: the `TokenizedContext` to split into passages.
+          passage_size: maximum number of WordPiece tokens of a passage.
+          k1: BM25 term frequency saturation.
+          b: BM25 passage length normalization.
+        """
+        self.context = context
+        (self.starts, self.stops) = sentence_passages(context, passage_size)
+
+        # passage of each WordPiece token
+        piece_starts = context.orig_to_tok_index[self.starts] if len(self.starts) else np.zeros(0, dtype=np.int64)
+        piece_passage = np.searchsorted(piece_starts, np.arange(len(context)), side="right") - 1
+        lengths = np.bincount(piece_passage, minlength=len(self.starts)).astype(np.float64)
+
+        # the non-zero (passage, term) entries and their term frequencies, by term then passage
+        terms = context.all_doc_token_ids.astype(np.int64)
+        keys = terms * max(len(self.starts), 1) + piece_passage
+        (keys, tf) = np.unique(keys, return_counts=True)
+        self._terms = keys // max(len(self.starts), 1)
+        self._passages = keys % max(len(self.starts), 1)
+
+        (unique_terms, df) = np.unique(self._terms, return_counts=True)
+        idf = np.log(1.0 + (len(self.starts) - df + 0.5) / (df + 0.5))
+        norm = k1 * (1.0 - b + b * lengths / max(lengths.mean(), 1.0)) if len(lengths) else lengths
+        self._weights = (idf[np.searchsorted(unique_terms, self._terms)] * tf * (k1 + 1.0) /
+                         (tf + norm[self._passages]))
+
+    def __len__(self):
+        """The number of passages."""
+        return len(self.starts)
+
+    def scores(self, query_ids):
+        """Returns the BM25 score of every passage against the WordPiece ids of a question."""
+        (query_terms, query_tf) = np.unique(np.asarray(query_ids, dtype=np.int64), return_counts=True)
+        lo = np.searchsorted(self._terms, query_terms, side="left")
+        hi = np.searchsorted(self._terms, query_terms, side="right")
+        counts = hi - lo
+        # the positions of the entries of every query term, concatenated
+        entries = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return np.bincount(self._passages[entries], weights=self._weights[entries] * np.repeat(query_tf, counts),
+                           minlength=len(self.starts))
+
+    def top_k(self, query_ids, k):
+        """Returns the indexes of the `k` best scoring passages for a question, in document order.
+
+        The ties go to the earlier passages.
+        """
+        if k >= len(self.starts):
+            return np.arange(len(self.starts))
+        scores = self.scores(query_ids)
+        best = np.lexsort((np.arange(len(scores)), -scores))[:k]
+        return np.sort(best)
+
+    def sub_context(self, passages):
+        """Returns the `TokenizedContext` of some of the passages, in the order given.
+
+        The character offsets of the tokens are those of the whole context, so
+        the answers found in the passages point into the original text. The
+        passages that follow each other in the context share a passage id, so an
+        answer can only span passages that are contiguous in the original text.
+        """
+        if len(passages) == len(self.starts):
+            return self.context
+        context = self.context
+        piece_bounds = np.append(context.orig_to_tok_index, len(context))
+        tokens = np.concatenate([np.arange(self.starts[p], self.stops[p]) for p in passages])
+        pieces = np.concatenate([np.arange(piece_bounds[self.starts[p]], piece_bounds[self.stops[p]])
+                                 for p in passages])
+
+        # the whitespace tokens are renumbered in their new order
+        new_index = np.zeros(len(context.doc_tokens), dtype=np.int32)
+        new_index[tokens] = np.arange(len(tokens), dtype=np.int32)
+        piece_counts = np.diff(piece_bounds)[tokens]
+        passages = np.asarray(passages)
+        passage_ids = np.cumsum(np.append(True, passages[1:] != passages[:-1] + 1)) - 1
+        passage_lengths = piece_bounds[self.stops[passages]] - piece_bounds[self.starts[passages]]
+        sub = TokenizedContext(
+            doc_tokens=[context.doc_tokens[i] for i in tokens],
+            all_doc_token_ids=context.all_doc_token_ids[pieces],
+            tok_to_orig_index=new_index[context.tok_to_orig_index[pieces]],
+            orig_to_tok_index=(np.cumsum(piece_counts) - piece_counts).astype(np.int32),
+            doc_token_starts=None if context.doc_token_starts is None else context.doc_token_starts[tokens],
+            passage_ids=np.repeat(passage_ids, passage_lengths).astype(np.int32))
+        if context.wordpiece_starts is not None:
+            sub.wordpiece_starts = context.wordpiece_starts[pieces]
+            sub.wordpiece_ends = context.wordpiece_ends[pieces]
+        return sub
@@ -19,9 +19,12 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import re
 from core.tokenization import printable_text
-import six
-import tensorflow as tf
+import numpy as np
+
+# the whitespace tokens of `split_doc_tokens`
+_DOC_TOKEN_RE = re.compile(u"[^ \t\r\n\u202f]+")
 
 
 class SquadExample(object):
@@ -30,6 +33,9 @@ class SquadExample(object):
        For examples without an answer, the start and end position are -1.
     """
 
+    __slots__ = ("qas_id", "question_text", "doc_tokens", "orig_answer_text", "start_position", "end_position",
+                 "is_impossible", "context")
+
     def __init__(self,
                  qas_id,
                  question_text,
@@ -37,7 +43,8 @@ class SquadExample(object):
                  orig_answer_text=None,
                  start_position=None,
                  end_position=None,
-                 is_impossible=False):
+                 is_impossible=False,
+                 context=None):
         self.qas_id = qas_id
         self.question_text = question_text
         self.doc_tokens = doc_tokens
@@ -45,6 +52,7 @@ class SquadExample(object):
         self.start_position = start_position
         self.end_position = end_position
         self.is_impossible = is_impossible
+        self.context = context
 
     def __str__(self):
         return self.__repr__()
@@ -64,58 +72,113 @@ class SquadExample(object):
 
 
 class InputFeatures(object):
-    """A single set of features of data."""
+    """A single set of features of data, a view of a row of an `InputFeatureBatch`.
 
-    def __init__(self,
-                 unique_id,
-                 example_index,
-                 doc_span_index,
-                 tokens,
-                 token_to_orig_map,
-                 token_is_max_context,
-                 input_ids,
-                 input_mask,
-                 segment_ids,
-                 start_position=None,
-                 end_position=None,
-                 is_impossible=None):
-        self.unique_id = unique_id
-        self.example_index = example_index
-        self.doc_span_index = doc_span_index
-        self.tokens = tokens
-        self.token_to_orig_map = token_to_orig_map
-        self.token_is_max_context = token_is_max_context
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.start_position = start_position
-        self.end_position = end_position
-        self.is_impossible = is_impossible
+    The token strings and the maps of the row are only built when they are read.
+    """
+
+    __slots__ = ("batch", "row")
+
+    def __init__(self, batch, row):
+        self.batch = batch
+        self.row = row
+
+    @property
+    def unique_id(self):
+        return int(self.batch.unique_ids[self.row])
+
+    @property
+    def example_index(self):
+        return int(self.batch.example_index[self.row])
+
+    @property
+    def doc_span_index(self):
+        return int(self.batch.doc_span_index[self.row])
 
+    @property
+    def input_ids(self):
+        return self.batch.input_ids[self.row]
 
-def read_squad_examples(input_data):
-    """Read data from a SQuAD json file into a list of SquadExample."""
+    @property
+    def input_mask(self):
+        return self.batch.input_mask[self.row]
+
+    @property
+    def segment_ids(self):
+        return self.batch.segment_ids[self.row]
+
+    @property
+    def is_impossible(self):
+        return self.batch.examples[self.example_index].is_impossible
+
+    @property
+    def tokens(self):
+        length = int(self.input_mask.sum())
+        return self.batch.tokenizer.convert_ids_to_tokens(self.input_ids[:length])
+
+    @property
+    def token_to_orig_map(self):
+        doc_offset = int(self.batch.doc_offset[self.row])
+        doc_start = int(self.batch.doc_start[self.row])
+        doc_end = doc_start + int(self.batch.doc_length[self.row])
+        tok_to_orig_index = self.batch.examples[self.example_index].context.tok_to_orig_index
+        return {doc_offset + i: int(orig_index) for (i, orig_index) in enumerate(tok_to_orig_index[doc_start:doc_end])}
+
+    @property
+    def token_is_max_context(self):
+        doc_offset = int(self.batch.doc_offset[self.row])
+        doc_length = int(self.batch.doc_length[self.row])
+        return {doc_offset + i: bool(is_max_context)
+                for (i, is_max_context) in enumerate(self.batch.start_mask[self.row, doc_offset:doc_offset + doc_length])}
+
+
+def split_doc_tokens(paragraph_text):
+    """Splits a paragraph into whitespace tokens, returns them with the token index of every character."""
     def is_whitespace(c):
         if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F:
             return True
         return False
 
-    examples = []
-    for paragraph in input_data["paragraphs"]:
-        paragraph_text = paragraph["context"]
-        doc_tokens = []
-        char_to_word_offset = []
-        prev_is_whitespace = True
-        for c in paragraph_text:
-            if is_whitespace(c):
-                prev_is_whitespace = True
+    doc_tokens = []
+    char_to_word_offset = []
+    prev_is_whitespace = True
+    for c in paragraph_text:
+        if is_whitespace(c):
+            prev_is_whitespace = True
+        else:
+            if prev_is_whitespace:
+                doc_tokens.append(c)
             else:
-                if prev_is_whitespace:
-                    doc_tokens.append(c)
-                else:
-                    doc_tokens[-1] += c
-                prev_is_whitespace = False
-            char_to_word_offset.append(len(doc_tokens) - 1)
+                doc_tokens[-1] += c
+            prev_is_whitespace = False
+        char_to_word_offset.append(len(doc_tokens) - 1)
+    return doc_tokens, char_to_word_offset
+
+
+def read_squad_examples(input_data, context_fn=None):
+    """Read data from a SQuAD json file into a list of SquadExample.
+
+    Args:
+      input_data: the SQuAD json data.
+      context_fn: optional callable returning the `TokenizedContext` of a
+        paragraph (the dict with its `context` text), e.g. from a cache. The examples of a paragraph then
+        share this pre-tokenized context.
+    """
+    return list(iter_squad_examples(input_data, context_fn=context_fn))
+
+
+def iter_squad_examples(input_data, context_fn=None):
+    """Like `read_squad_examples`, but yields the examples one paragraph at a time.
+
+    `input_data["paragraphs"]` may be any iterable, e.g. a generator.
+    """
+    for paragraph in input_data["paragraphs"]:
+        context = None
+        if context_fn is not None:
+            context = context_fn(paragraph)
+            doc_tokens = context.doc_tokens
+        else:
+            doc_tokens, _ = split_doc_tokens(paragraph["context"])
 
         for qa in paragraph["questions"]:
 
@@ -126,141 +189,353 @@ def read_squad_examples(input_data):
                 orig_answer_text="",
                 start_position=-1,
                 end_position=-1,
-                is_impossible=False)
-            examples.append(example)
+                is_impossible=False,
+                context=context)
+            yield example
+
+
+class TokenizedContext(object):
+    """The WordPiece tokenization of a paragraph, shared by all the questions asked about it.
+
+    The WordPiece ids and the maps between WordPiece and whitespace tokens are
+    int32 arrays, the WordPiece strings are rebuilt from the ids when needed.
+    `doc_token_starts` holds the character offset of each whitespace token in
+    the paragraph text, and `wordpiece_starts` and `wordpiece_ends` the
+    `[start, end)` character offsets of each WordPiece token, when they are known.
+    A context made of passages that are not contiguous in the paragraph has the
+    `passage_ids` of its WordPiece tokens, an answer cannot span two passages.
+    """
 
-    return examples
+    __slots__ = ("doc_tokens", "all_doc_token_ids", "tok_to_orig_index", "orig_to_tok_index", "doc_token_starts",
+                 "wordpiece_starts", "wordpiece_ends", "passage_ids")
+
+    def __init__(self,
+                 doc_tokens,
+                 all_doc_token_ids,
+                 tok_to_orig_index,
+                 orig_to_tok_index,
+                 doc_token_starts=None,
+                 wordpiece_starts=None,
+                 wordpiece_ends=None,
+                 passage_ids=None):
+        self.doc_tokens = doc_tokens
+        self.all_doc_token_ids = all_doc_token_ids
+        self.tok_to_orig_index = tok_to_orig_index
+        self.orig_to_tok_index = orig_to_tok_index
+        self.doc_token_starts = doc_token_starts
+        self.wordpiece_starts = wordpiece_starts
+        self.wordpiece_ends = wordpiece_ends
+        self.passage_ids = passage_ids
+
+    def __len__(self):
+        """The number of WordPiece tokens of the paragraph."""
+        return len(self.all_doc_token_ids)
+
+
+def doc_token_spans(paragraph_text):
+    """Splits a paragraph into the whitespace tokens of `split_doc_tokens`, returns them with their character offsets."""
+    doc_tokens = []
+    starts = []
+    for match in _DOC_TOKEN_RE.finditer(paragraph_text):
+        doc_tokens.append(match.group())
+        starts.append(match.start())
+    return doc_tokens, np.array(starts, dtype=np.int32)
+
+
+def tokenize_context(doc_tokens, tokenizer, doc_token_starts=None):
+    """WordPiece-tokenizes the whitespace tokens of a paragraph.
+
+    Given the character offsets of the whitespace tokens, the character offsets
+    of the WordPiece tokens are recorded as well.
+    """
+    tok_to_orig_index = []
+    orig_to_tok_index = []
+    all_doc_token_ids = []
+    # offsets of the WordPiece tokens in their whitespace token
+    wordpiece_starts = []
+    wordpiece_ends = []
+    for (i, token) in enumerate(doc_tokens):
+        orig_to_tok_index.append(len(all_doc_token_ids))
+        if doc_token_starts is None:
+            _, sub_token_ids = tokenizer.tokenize_to_ids(token)
+        else:
+            _, sub_token_ids, starts, ends = tokenizer.tokenize_with_offsets(token)
+            wordpiece_starts.extend(starts)
+            wordpiece_ends.extend(ends)
+        tok_to_orig_index.extend([i] * len(sub_token_ids))
+        all_doc_token_ids.extend(sub_token_ids)
+
+    context = TokenizedContext(
+        doc_tokens=doc_tokens,
+        all_doc_token_ids=np.array(all_doc_token_ids, dtype=np.int32),
+        tok_to_orig_index=np.array(tok_to_orig_index, dtype=np.int32),
+        orig_to_tok_index=np.array(orig_to_tok_index, dtype=np.int32),
+        doc_token_starts=doc_token_starts)
+    if doc_token_starts is not None:
+        token_starts = np.asarray(doc_token_starts, dtype=np.int32)[context.tok_to_orig_index]
+        context.wordpiece_starts = token_starts + np.array(wordpiece_starts, dtype=np.int32)
+        context.wordpiece_ends = token_starts + np.array(wordpiece_ends, dtype=np.int32)
+    return context
+
+
+def update_context(context, paragraph_text, new_paragraph_text, tokenizer):
+    """Returns the tokenized context of an edited paragraph, given the one of its previous text.
+
+    The texts are compared by their common prefix and suffix, only the whitespace
+    tokens in between (and the ones the edit touches) are WordPiece-tokenized
+    again. The tokens and maps of the rest of the paragraph are copied, shifted
+    by the change in length of the edited part.
+    """
+    doc_token_starts = context.doc_token_starts
+    if doc_token_starts is None:
+        _, doc_token_starts = doc_token_spans(paragraph_text)
+    doc_token_ends = doc_token_starts + np.array([len(token) for token in context.doc_tokens], dtype=np.int32)
+
+    # the edit replaced paragraph_text[prefix:old_end] by new_paragraph_text[prefix:old_end + shift]
+    prefix = _common_prefix_length(paragraph_text, new_paragraph_text)
+    suffix = _common_prefix_length(paragraph_text[prefix:][::-1], new_paragraph_text[prefix:][::-1])
+    old_end = len(paragraph_text) - suffix
+    shift = len(new_paragraph_text) - len(paragraph_text)
+
+    # whitespace tokens that overlap the edit, or touch it and may be extended by it
+    first = int(np.searchsorted(doc_token_ends, prefix, side="left"))
+    stop = int(np.searchsorted(doc_token_starts, old_end, side="right"))
+    start_char = min(prefix, int(doc_token_starts[first])) if first < stop else prefix
+    end_char = max(old_end, int(doc_token_ends[stop - 1])) if first < stop else old_end
+
+    new_tokens, new_starts = doc_token_spans(new_paragraph_text[start_char:end_char + shift])
+    edited = tokenize_context(new_tokens, tokenizer, doc_token_starts=new_starts)
+
+    num_doc_tokens = len(context.doc_tokens)
+    piece_start = int(context.orig_to_tok_index[first]) if first < num_doc_tokens else len(context)
+    piece_stop = int(context.orig_to_tok_index[stop]) if stop < num_doc_tokens else len(context)
+    token_shift = len(new_tokens) - (stop - first)
+
+    return TokenizedContext(
+        doc_tokens=context.doc_tokens[:first] + new_tokens + context.doc_tokens[stop:],
+        all_doc_token_ids=np.concatenate([
+            context.all_doc_token_ids[:piece_start], edited.all_doc_token_ids,
+            context.all_doc_token_ids[piece_stop:]]).astype(np.int32),
+        tok_to_orig_index=np.concatenate([
+            context.tok_to_orig_index[:piece_start], edited.tok_to_orig_index + first,
+            context.tok_to_orig_index[piece_stop:] + token_shift]).astype(np.int32),
+        orig_to_tok_index=np.concatenate([
+            context.orig_to_tok_index[:first], edited.orig_to_tok_index + piece_start,
+            context.orig_to_tok_index[stop:] + (len(edited) - (piece_stop - piece_start))]).astype(np.int32),
+        doc_token_starts=np.concatenate([
+            doc_token_starts[:first], new_starts + start_char, doc_token_starts[stop:] + shift]).astype(np.int32),
+        wordpiece_starts=_patch_offsets(context.wordpiece_starts, piece_start, piece_stop, edited.wordpiece_starts,
+                                        start_char, shift),
+        wordpiece_ends=_patch_offsets(context.wordpiece_ends, piece_start, piece_stop, edited.wordpiece_ends,
+                                      start_char, shift))
+
+
+def _patch_offsets(offsets, start, stop, edited_offsets, edit_start, shift):
+    """Replaces `offsets[start:stop]` by the offsets of the edited part, which start at `edit_start`."""
+    if offsets is None:
+        return None
+    return np.concatenate([offsets[:start], edited_offsets + edit_start, offsets[stop:] + shift]).astype(np.int32)
+
+
+def _common_prefix_length(a, b):
+    """Length of the common prefix of two strings, found by bisection on slice comparisons."""
+    low = 0
+    high = min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _doc_span_layout(num_doc_tokens, max_tokens_for_doc, doc_stride):
+    """Splits a document into doc spans, returns them with the max context span of each token."""
+
+    # We can have documents that are longer than the maximum sequence length.
+    # To deal with this we do a sliding window approach, where we take chunks
+    # of the up to our max length with a stride of `doc_stride`.
+    _DocSpan = collections.namedtuple(  # pylint: disable=invalid-name
+        "DocSpan", ["start", "length"])
+    doc_spans = []
+    start_offset = 0
+    while start_offset < num_doc_tokens:
+        length = num_doc_tokens - start_offset
+        if length > max_tokens_for_doc:
+            length = max_tokens_for_doc
+        doc_spans.append(_DocSpan(start=start_offset, length=length))
+        if start_offset + length == num_doc_tokens:
+            break
+        start_offset += min(length, doc_stride)
+
+    return doc_spans, _max_context_spans(doc_spans, num_doc_tokens)
+
+
+def num_doc_spans(num_doc_tokens, max_tokens_for_doc, doc_stride):
+    """Returns the number of doc spans `_doc_span_layout` splits a document into."""
+    count = 0
+    start_offset = 0
+    while start_offset < num_doc_tokens:
+        count += 1
+        length = min(num_doc_tokens - start_offset, max_tokens_for_doc)
+        if start_offset + length == num_doc_tokens:
+            break
+        start_offset += min(length, doc_stride)
+    return count
+
+
+class InputFeatureBatch(object):
+    """The features of a list of examples, one row per window (doc span).
+
+    The model inputs are int32 matrices of shape [num_features, max_seq_length]
+    that are fed to the model as they are. The per-feature metadata lives in
+    parallel arrays: the doc tokens of row `i` are the WordPiece tokens
+    `doc_start[i]:doc_start[i] + doc_length[i]` of the context of example
+    `example_index[i]`, placed at `doc_offset[i]` in the row. Indexing the batch
+    gives the `InputFeatures` of a row, with its tokens rebuilt from the ids.
+    """
+
+    __slots__ = ("examples", "tokenizer", "input_ids", "input_mask", "segment_ids", "unique_ids", "example_index",
+                 "doc_span_index", "doc_start", "doc_length", "doc_offset", "start_mask", "end_mask")
+
+    def __init__(self, num_features, max_seq_length, examples, tokenizer):
+        self.examples = examples
+        self.tokenizer = tokenizer
+        self.input_ids = np.zeros((num_features, max_seq_length), dtype=np.int32)
+        self.input_mask = np.zeros((num_features, max_seq_length), dtype=np.int32)
+        self.segment_ids = np.zeros((num_features, max_seq_length), dtype=np.int32)
+        self.unique_ids = np.zeros(num_features, dtype=np.int32)
+        self.example_index = np.zeros(num_features, dtype=np.int32)
+        self.doc_span_index = np.zeros(num_features, dtype=np.int32)
+        self.doc_start = np.zeros(num_features, dtype=np.int32)
+        self.doc_length = np.zeros(num_features, dtype=np.int32)
+        self.doc_offset = np.zeros(num_features, dtype=np.int32)
+        # positions an answer may start at (the doc tokens the window gives
+        # their maximum context) and end at (all the doc tokens)
+        self.start_mask = np.zeros((num_features, max_seq_length), dtype=bool)
+        self.end_mask = np.zeros((num_features, max_seq_length), dtype=bool)
+
+    def __len__(self):
+        return len(self.unique_ids)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        return InputFeatures(self, i)
 
 
 def convert_examples_to_features(examples, tokenizer, max_seq_length,
                                  doc_stride, max_query_length):
-    """Loads a data file into a list of `InputBatch`s."""
+    """Converts a list of examples into an `InputFeatureBatch`.
 
-    features = []
-    unique_id = 1000000000
+    The examples without a tokenized context get the context tokenized here.
+    """
+    for features in iter_feature_batches(examples, tokenizer, max_seq_length, doc_stride, max_query_length):
+        return features
+    return InputFeatureBatch(0, max_seq_length, [], tokenizer)
 
-    for (example_index, example) in enumerate(examples):
-        query_tokens = tokenizer.tokenize(example.question_text)
-
-        if len(query_tokens) > max_query_length:
-            query_tokens = query_tokens[0:max_query_length]
-
-        tok_to_orig_index = []
-        orig_to_tok_index = []
-        all_doc_tokens = []
-        for (i, token) in enumerate(example.doc_tokens):
-            orig_to_tok_index.append(len(all_doc_tokens))
-            sub_tokens = tokenizer.tokenize(token)
-            for sub_token in sub_tokens:
-                tok_to_orig_index.append(i)
-                all_doc_tokens.append(sub_token)
-
-        # The -3 accounts for [CLS], [SEP] and [SEP]
-        max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
-
-        # We can have documents that are longer than the maximum sequence length.
-        # To deal with this we do a sliding window approach, where we take chunks
-        # of the up to our max length with a stride of `doc_stride`.
-        _DocSpan = collections.namedtuple(  # pylint: disable=invalid-name
-            "DocSpan", ["start", "length"])
-        doc_spans = []
-        start_offset = 0
-        while start_offset < len(all_doc_tokens):
-            length = len(all_doc_tokens) - start_offset
-            if length > max_tokens_for_doc:
-                length = max_tokens_for_doc
-            doc_spans.append(_DocSpan(start=start_offset, length=length))
-            if start_offset + length == len(all_doc_tokens):
-                break
-            start_offset += min(length, doc_stride)
 
-        for (doc_span_index, doc_span) in enumerate(doc_spans):
-            tokens = []
-            token_to_orig_map = {}
-            token_is_max_context = {}
-            segment_ids = []
-            tokens.append("[CLS]")
-            segment_ids.append(0)
-            for token in query_tokens:
-                tokens.append(token)
-                segment_ids.append(0)
-            tokens.append("[SEP]")
-            segment_ids.append(0)
-
-            for i in range(doc_span.length):
-                split_token_index = doc_span.start + i
-                token_to_orig_map[len(tokens)] = tok_to_orig_index[
-                    split_token_index]
-
-                is_max_context = _check_is_max_context(doc_spans, doc_span_index,
-                                                       split_token_index)
-                token_is_max_context[len(tokens)] = is_max_context
-                tokens.append(all_doc_tokens[split_token_index])
-                segment_ids.append(1)
-            tokens.append("[SEP]")
-            segment_ids.append(1)
-
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-            # The mask has 1 for real tokens and 0 for padding tokens. Only real
-            # tokens are attended to.
-            input_mask = [1] * len(input_ids)
-
-            # Zero-pad up to the sequence length.
-            while len(input_ids) < max_seq_length:
-                input_ids.append(0)
-                input_mask.append(0)
-                segment_ids.append(0)
-
-            if len(input_ids) != max_seq_length:
-                raise ValueError("input_ids has invalid length: %r" % len(input_ids))
-
-            if len(input_mask) != max_seq_length:
-                raise ValueError("input_mask has invalid length: %r" % len(input_mask))
-
-            if len(segment_ids) != max_seq_length:
-                raise ValueError("segment_ids has invalid length: %r" % len(segment_ids))
-
-            start_position = None
-            end_position = None
-
-            if example_index < 20:
-                tf.logging.info("*** Example ***")
-                tf.logging.info("unique_id: %s" % unique_id)
-                tf.logging.info("example_index: %s" % example_index)
-                tf.logging.info("doc_span_index: %s" % doc_span_index)
-                tf.logging.info("tokens: %s" % " ".join(
-                    [printable_text(x) for x in tokens]))
-                tf.logging.info("token_to_orig_map: %s" % " ".join(
-                    ["%d:%d" % (x, y) for (x, y) in six.iteritems(token_to_orig_map)]))
-                tf.logging.info("token_is_max_context: %s" % " ".join([
-                    "%d:%s" % (x, y) for (x, y) in six.iteritems(token_is_max_context)
-                ]))
-                tf.logging.info("input_ids: %s" %
-                                " ".join([str(x) for x in input_ids]))
-                tf.logging.info(
-                    "input_mask: %s" % " ".join([str(x) for x in input_mask]))
-                tf.logging.info(
-                    "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-
-            feature = InputFeatures(
-                unique_id=unique_id,
-                example_index=example_index,
-                doc_span_index=doc_span_index,
-                tokens=tokens,
-                token_to_orig_map=token_to_orig_map,
-                token_is_max_context=token_is_max_context,
-                input_ids=input_ids,
-                input_mask=input_mask,
-                segment_ids=segment_ids,
-                start_position=start_position,
-                end_position=end_position,
-                is_impossible=example.is_impossible)
-
-            # # Run callback
-            # output_fn(feature)
-            features.append(feature)
+def iter_feature_batches(examples, tokenizer, max_seq_length, doc_stride,
+                         max_query_length, max_features=None):
+    """Converts an iterable of examples into `InputFeatureBatch`es of up to `max_features` features.
+
+    The examples are consumed lazily, as the batches are. The windows of an
+    example are never split across batches, so an example with more than
+    `max_features` windows gets a batch of its own. Without `max_features`, all
+    the examples go into a single batch.
+    """
+    unique_id = 1000000000
 
+    # The questions asked about the same paragraph share its `doc_tokens`, so
+    # each paragraph is WordPiece-tokenized (and split into doc spans for a
+    # given question length) only once, unless the examples already carry
+    # their tokenized context. Only the paragraph of the current example is
+    # kept, so memory does not grow with the number of paragraphs.
+    contexts = {}
+    layouts = {}
+
+    # The windows of the examples of a batch are laid out first, so the feature
+    # matrices are allocated once and filled in place.
+    batch_examples = []
+    batch_windows = []
+    num_features = 0
+    for example in examples:
+        windows = _example_windows(example, tokenizer, max_seq_length, doc_stride, max_query_length, contexts,
+                                   layouts)
+        if batch_examples and max_features is not None and num_features + len(windows[2][0]) > max_features:
+            yield _fill_features(batch_examples, batch_windows, num_features, tokenizer, max_seq_length, unique_id)
+            unique_id += num_features
+            batch_examples = []
+            batch_windows = []
+            num_features = 0
+        batch_examples.append(example)
+        batch_windows.append(windows)
+        num_features += len(windows[2][0])
+
+    if batch_examples:
+        yield _fill_features(batch_examples, batch_windows, num_features, tokenizer, max_seq_length, unique_id)
+
+
+def _example_windows(example, tokenizer, max_seq_length, doc_stride, max_query_length, contexts, layouts):
+    """Returns the query ids, the doc ids and the doc span layout of an example."""
+    _, query_ids = tokenizer.tokenize_to_ids(example.question_text)
+
+    if len(query_ids) > max_query_length:
+        query_ids = query_ids[0:max_query_length]
+
+    context_key = id(example.doc_tokens)
+    if context_key not in contexts:
+        contexts.clear()
+        layouts.clear()
+        if example.context is None:
+            example.context = tokenize_context(example.doc_tokens, tokenizer)
+        contexts[context_key] = example.context
+    example.context = contexts[context_key]
+
+    # The -3 accounts for [CLS], [SEP] and [SEP]
+    max_tokens_for_doc = max_seq_length - len(query_ids) - 3
+
+    layout_key = (context_key, max_tokens_for_doc)
+    if layout_key not in layouts:
+        layouts[layout_key] = _doc_span_layout(len(example.context), max_tokens_for_doc, doc_stride)
+    return query_ids, example.context.all_doc_token_ids, layouts[layout_key]
+
+
+def _fill_features(examples, windows, num_features, tokenizer, max_seq_length, unique_id):
+    features = InputFeatureBatch(num_features, max_seq_length, examples, tokenizer)
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    row = 0
+    for (example_index, (query_ids, doc_ids, (doc_spans, max_context_span))) in enumerate(windows):
+        # [CLS] query [SEP] doc tokens [SEP], then zero padding. The mask has 1
+        # for real tokens and 0 for padding tokens. Only real tokens are
+        # attended to.
+        doc_offset = len(query_ids) + 2
+        for (doc_span_index, doc_span) in enumerate(doc_spans):
+            doc_end = doc_offset + doc_span.length
+            input_ids = features.input_ids[row]
+            input_ids[0] = cls_id
+            input_ids[1:doc_offset - 1] = query_ids
+            input_ids[doc_offset - 1] = sep_id
+            input_ids[doc_offset:doc_end] = doc_ids[doc_span.start:doc_span.start + doc_span.length]
+            input_ids[doc_end] = sep_id
+            features.input_mask[row, :doc_end + 1] = 1
+            features.segment_ids[row, doc_offset:doc_end + 1] = 1
+
+            features.start_mask[row, doc_offset:doc_end] = \
+                max_context_span[doc_span.start:doc_span.start + doc_span.length] == doc_span_index
+            features.end_mask[row, doc_offset:doc_end] = True
+
+            features.unique_ids[row] = unique_id
+            features.example_index[row] = example_index
+            features.doc_span_index[row] = doc_span_index
+            features.doc_start[row] = doc_span.start
+            features.doc_length[row] = doc_span.length
+            features.doc_offset[row] = doc_offset
+
+            row += 1
             unique_id += 1
     return features
 
@@ -302,6 +577,27 @@ def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
     return input_start, input_end
 
 
+def _max_context_spans(doc_spans, num_doc_tokens):
+    """Returns the index of the 'max context' doc span of every token, in one pass over the spans.
+
+    This gives the same result as `_check_is_max_context` for every token, without
+    scanning all the doc spans for each of them.
+    """
+    best_score = np.full(num_doc_tokens, -1.0)
+    best_span_index = np.zeros(num_doc_tokens, dtype=np.int32)
+    for (span_index, doc_span) in enumerate(doc_spans):
+        num_left_context = np.arange(doc_span.length)
+        num_right_context = doc_span.length - 1 - num_left_context
+        score = np.minimum(num_left_context, num_right_context) + 0.01 * doc_span.length
+        span_best_score = best_score[doc_span.start:doc_span.start + doc_span.length]
+        span_best_index = best_span_index[doc_span.start:doc_span.start + doc_span.length]
+        # the first span with the best score wins, as in `_check_is_max_context`
+        better = score > span_best_score
+        span_best_score[better] = score[better]
+        span_best_index[better] = span_index
+    return best_span_index
+
+
 def _check_is_max_context(doc_spans, cur_span_index, position):
     """Check if this is the 'max context' doc span for the token."""
 
@@ -23,6 +23,7 @@ import re
 import unicodedata
 import six
 import tensorflow as tf
+from core.caching import LRUCache
 
 
 def validate_case_matches_checkpoint(do_lower_case, init_checkpoint):
@@ -147,19 +148,79 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
     """Runs end-to-end tokenization."""
 
-    def __init__(self, vocab_file, do_lower_case=True):
+    def __init__(self, vocab_file, do_lower_case=True, word_cache_size=0):
+        """Constructs a FullTokenizer.
+
+        Args:
+          vocab_file: the WordPiece vocabulary file.
+          do_lower_case: Whether to lower case the input.
+          word_cache_size: number of whitespace tokens whose word pieces (and
+            their ids) are kept in an LRU cache, 0 disables the cache.
+        """
         self.vocab = load_vocab(vocab_file)
         self.inv_vocab = {v: k for k, v in self.vocab.items()}
         self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+        self.word_cache = LRUCache(word_cache_size) if word_cache_size else None
 
     def tokenize(self, text):
+        return self.tokenize_to_ids(text)[0]
+
+    def tokenize_to_ids(self, text):
+        """Tokenizes a piece of text, returns its word pieces and their ids."""
         split_tokens = []
-        for token in self.basic_tokenizer.tokenize(text):
-            for sub_token in self.wordpiece_tokenizer.tokenize(token):
-                split_tokens.append(sub_token)
+        split_ids = []
+        for word in self.basic_tokenizer.split_words(text):
+            # natural language text repeats the same words over and over, so
+            # the word pieces of each whitespace token are memoized
+            pieces = self.word_cache.get(word) if self.word_cache is not None else None
+            if pieces is None:
+                tokens = []
+                for token in self.basic_tokenizer.tokenize_word(word):
+                    tokens.extend(self.wordpiece_tokenizer.tokenize(token))
+                pieces = (tokens, convert_by_vocab(self.vocab, tokens))
+                if self.word_cache is not None:
+                    self.word_cache.put(word, pieces)
+            split_tokens.extend(pieces[0])
+            split_ids.extend(pieces[1])
+
+        return split_tokens, split_ids
+
+    def tokenize_with_offsets(self, text):
+        """Tokenizes a piece of text, returns its word pieces, their ids and their `[start, end)` character offsets.
+
+        The offsets are indices in `text`. They are memoized with the word pieces,
+        so `text` should be a whitespace token.
+        """
+        entry = self.word_cache.get(text) if self.word_cache is not None else None
+        if entry is not None and len(entry) == 4:
+            return entry
 
-        return split_tokens
+        split_tokens = []
+        starts = []
+        ends = []
+        (basic_tokens, char_offsets) = self.basic_tokenizer.tokenize_with_offsets(text)
+        for (i, token) in enumerate(basic_tokens):
+            pieces = self.wordpiece_tokenizer.tokenize(token)
+            split_tokens.extend(pieces)
+            if char_offsets is None:
+                # the characters of the tokens could not be aligned with the text
+                starts.extend([0] * len(pieces))
+                ends.extend([len(text)] * len(pieces))
+            elif pieces == [self.wordpiece_tokenizer.unk_token]:
+                starts.append(char_offsets[i][0])
+                ends.append(char_offsets[i][-1])
+            else:
+                position = 0
+                for piece in pieces:
+                    starts.append(char_offsets[i][position])
+                    position += len(piece) - 2 if position > 0 else len(piece)
+                    ends.append(char_offsets[i][position])
+
+        entry = (split_tokens, convert_by_vocab(self.vocab, split_tokens), starts, ends)
+        if self.word_cache is not None:
+            self.word_cache.put(text, entry)
+        return entry
 
     def convert_tokens_to_ids(self, tokens):
         return convert_by_vocab(self.vocab, tokens)
@@ -181,6 +242,81 @@ class BasicTokenizer(object):
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
+        output_tokens = []
+        for word in self.split_words(text):
+            output_tokens.extend(self.tokenize_word(word))
+        return output_tokens
+
+    def tokenize_with_offsets(self, text):
+        """Tokenizes a piece of text, returns its tokens and where their characters come from in `text`.
+
+        The offsets of a token are the index in `text` of each of its characters,
+        followed by the end of the token. The characters dropped by the cleanup
+        or by accent stripping belong to the token before them. The offsets are
+        `None` if the characters cannot be aligned one by one with the text.
+        """
+        text = convert_to_unicode(text)
+        tokens = self.tokenize(text)
+
+        if _is_ascii(text) and _ASCII_CONTROL_RE.search(text) is None:
+            # every character but whitespace is kept as it is (or lower cased),
+            # each token is found right after the previous one
+            if self.do_lower_case:
+                text = text.lower()
+            char_offsets = []
+            position = 0
+            for token in tokens:
+                start = text.find(token, position)
+                position = start + len(token)
+                char_offsets.append(list(range(start, position + 1)))
+            return tokens, char_offsets
+
+        # a lower casing that depends on the neighbouring characters (the final
+        # sigma) changes characters but not their positions
+        (aligned_tokens, char_offsets) = self._align_chars(text)
+        if [len(token) for token in aligned_tokens] != [len(token) for token in tokens]:
+            return tokens, None
+        return tokens, char_offsets
+
+    def _align_chars(self, text):
+        """Runs the basic tokenization one character at a time, recording where each character comes from."""
+        tokens = []
+        char_offsets = []
+        # whether the last token still needs its end offset, and whether it can still grow
+        open_token = False
+        growing = False
+        for (i, char) in enumerate(text):
+            cp = ord(char)
+            if cp == 0 or cp == 0xfffd or _is_control(char):
+                continue
+            if _is_whitespace(char):
+                if open_token:
+                    char_offsets[-1].append(i)
+                open_token = growing = False
+                continue
+
+            chinese = self._is_chinese_char(cp)
+            normalized = char
+            if self.do_lower_case and not chinese:
+                normalized = self._run_strip_accents(char.lower())
+            for c in normalized:
+                if growing and not chinese and not _is_punctuation(c):
+                    tokens[-1].append(c)
+                    char_offsets[-1].append(i)
+                    continue
+                if open_token:
+                    char_offsets[-1].append(i)
+                tokens.append([c])
+                char_offsets.append([i])
+                open_token = True
+                growing = not chinese and not _is_punctuation(c)
+        if open_token:
+            char_offsets[-1].append(len(text))
+
+        return ["".join(token) for token in tokens], char_offsets
+
+    def split_words(self, text):
+        """Cleans up a piece of text and splits it into whitespace tokens."""
         text = convert_to_unicode(text)
         text = self._clean_text(text)
 
@@ -192,20 +328,23 @@ class BasicTokenizer(object):
         # words in the English Wikipedia.).
         text = self._tokenize_chinese_chars(text)
 
-        orig_tokens = whitespace_tokenize(text)
-        split_tokens = []
-        for token in orig_tokens:
-            if self.do_lower_case:
-                token = token.lower()
-                token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
+        return whitespace_tokenize(text)
 
-        output_tokens = whitespace_tokenize(" ".join(split_tokens))
-        return output_tokens
+    def tokenize_word(self, word):
+        """Tokenizes a whitespace token of `split_words` (lower casing, punctuation splitting)."""
+        if self.do_lower_case:
+            word = word.lower()
+            word = self._run_strip_accents(word)
+        return whitespace_tokenize(" ".join(self._run_split_on_punc(word)))
 
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
+        # NFD leaves ASCII text unchanged and it has no combining marks
+        if _is_ascii(text):
+            return text
         text = unicodedata.normalize("NFD", text)
+        if not _has_non_bmp(text):
+            return _MARK_RE.sub("", text)
         output = []
         for char in text:
             cat = unicodedata.category(char)
@@ -216,6 +355,11 @@ class BasicTokenizer(object):
 
     def _run_split_on_punc(self, text):
         """Splits punctuation on a piece of text."""
+        if not _has_non_bmp(text):
+            # every punctuation character is a piece of its own, and so is
+            # every run of other characters between them
+            return [piece for piece in _PUNCTUATION_RE.split(text) if piece]
+
         chars = list(text)
         i = 0
         start_new_word = True
@@ -236,16 +380,9 @@ class BasicTokenizer(object):
 
     def _tokenize_chinese_chars(self, text):
         """Adds whitespace around any CJK character."""
-        output = []
-        for char in text:
-            cp = ord(char)
-            if self._is_chinese_char(cp):
-                output.append(" ")
-                output.append(char)
-                output.append(" ")
-            else:
-                output.append(char)
-        return "".join(output)
+        if _is_ascii(text):
+            return text
+        return _CHINESE_CHAR_RE.sub(r" \1 ", text)
 
     def _is_chinese_char(self, cp):
         """Checks whether CP is the codepoint of a CJK character."""
@@ -257,20 +394,17 @@ class BasicTokenizer(object):
         # as is Japanese Hiragana and Katakana. Those alphabets are used to write
         # space-separated words, so they are not treated specially and handled
         # like the all of the other languages.
-        if ((0x4E00 <= cp <= 0x9FFF) or
-                (0x3400 <= cp <= 0x4DBF) or
-                (0x20000 <= cp <= 0x2A6DF) or
-                (0x2A700 <= cp <= 0x2B73F) or
-                (0x2B740 <= cp <= 0x2B81F) or
-                (0x2B820 <= cp <= 0x2CEAF) or
-                (0xF900 <= cp <= 0xFAFF) or
-                (0x2F800 <= cp <= 0x2FA1F)):
-            return True
+        for (first, last) in _CHINESE_CHAR_RANGES:
+            if first <= cp <= last:
+                return True
 
         return False
 
     def _clean_text(self, text):
         """Performs invalid character removal and whitespace cleanup on text."""
+        if not _has_non_bmp(text):
+            return text.translate(_CLEAN_TEXT_TABLE)
+
         output = []
         for char in text:
             cp = ord(char)
@@ -291,11 +425,17 @@ class WordpieceTokenizer(object):
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
 
+        # Prefix tries of the vocab: one for the pieces that start a word and
+        # one for the "##" pieces that continue it (without their "##").
+        self._word_trie = _build_trie(vocab)
+        self._suffix_trie = _build_trie([piece for piece in vocab if piece.startswith("##")], skip=2)
+
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
 
         This uses a greedy longest-match-first algorithm to perform tokenization
-        using the given vocabulary.
+        using the given vocabulary. The longest match at each position is found
+        in a single forward walk down a prefix trie of the vocabulary.
 
         For example:
           input = "unaffable"
@@ -313,25 +453,26 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
+            if len(token) > self.max_input_chars_per_word:
                 output_tokens.append(self.unk_token)
                 continue
 
             is_bad = False
             start = 0
             sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
+            while start < len(token):
+                node = self._word_trie if start == 0 else self._suffix_trie
                 cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
+                end = start
+                i = start
+                while i < len(token):
+                    node = node.get(token[i])
+                    if node is None:
                         break
-                    end -= 1
+                    i += 1
+                    if _TRIE_END in node:
+                        cur_substr = node[_TRIE_END]
+                        end = i
                 if cur_substr is None:
                     is_bad = True
                     break
@@ -345,6 +486,26 @@ class WordpieceTokenizer(object):
         return output_tokens
 
 
+# key of the vocab piece ending at a trie node, no character can collide with it
+_TRIE_END = ""
+
+
+def _build_trie(pieces, skip=0):
+    """Builds a prefix trie of nested dicts over the pieces (without their first `skip` characters).
+
+    Each piece is stored under the `_TRIE_END` key of the node its last character leads to.
+    """
+    root = {}
+    for piece in pieces:
+        if len(piece) <= skip:
+            continue
+        node = root
+        for char in piece[skip:]:
+            node = node.setdefault(char, {})
+        node[_TRIE_END] = piece
+    return root
+
+
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
     # \t, \n, and \r are technically control characters but we treat them
@@ -382,3 +543,84 @@ def _is_punctuation(char):
     if cat.startswith("P"):
         return True
     return False
+
+
+# The CJK Unicode blocks, see `BasicTokenizer._is_chinese_char`.
+_CHINESE_CHAR_RANGES = [
+    (0x4E00, 0x9FFF),
+    (0x3400, 0x4DBF),
+    (0x20000, 0x2A6DF),
+    (0x2A700, 0x2B73F),
+    (0x2B740, 0x2B81F),
+    (0x2B820, 0x2CEAF),
+    (0xF900, 0xFAFF),
+    (0x2F800, 0x2FA1F),
+]
+
+# Character classes of the Basic Multilingual Plane, one byte of flags per code
+# point, so that tokenizing text does not call `unicodedata.category` for each
+# of its characters. Text with characters outside the BMP takes the per
+# character path.
+_WHITESPACE = 1
+_CONTROL = 2
+_PUNCTUATION = 4
+_MARK = 8
+
+
+def _build_char_classes():
+    classes = bytearray(0x10000)
+    for cp in range(0x10000):
+        if 0xD800 <= cp <= 0xDFFF:
+            continue  # surrogates
+        char = six.unichr(cp)
+        if _is_whitespace(char):
+            classes[cp] |= _WHITESPACE
+        if _is_control(char):
+            classes[cp] |= _CONTROL
+        if _is_punctuation(char):
+            classes[cp] |= _PUNCTUATION
+        if unicodedata.category(char) == "Mn":
+            classes[cp] |= _MARK
+    return classes
+
+
+def _char_class_re(classes, flag):
+    """Builds a regular expression matching one character of the BMP code points with `flag` set."""
+    ranges = []
+    for cp in range(len(classes)):
+        if classes[cp] & flag:
+            if ranges and ranges[-1][1] == cp - 1:
+                ranges[-1][1] = cp
+            else:
+                ranges.append([cp, cp])
+    return "[" + "".join("\\U%08x-\\U%08x" % (first, last) for (first, last) in ranges) + "]"
+
+
+_CHAR_CLASSES = _build_char_classes()
+
+# `_clean_text` drops NUL, U+FFFD and control characters, and maps whitespace to spaces
+_CLEAN_TEXT_TABLE = {cp: None for cp in range(len(_CHAR_CLASSES)) if _CHAR_CLASSES[cp] & _CONTROL}
+_CLEAN_TEXT_TABLE.update({cp: u" " for cp in range(len(_CHAR_CLASSES)) if _CHAR_CLASSES[cp] & _WHITESPACE})
+_CLEAN_TEXT_TABLE.update({0: None, 0xfffd: None})
+
+_PUNCTUATION_RE = re.compile("(" + _char_class_re(_CHAR_CLASSES, _PUNCTUATION) + ")")
+_MARK_RE = re.compile(_char_class_re(_CHAR_CLASSES, _MARK))
+_CHINESE_CHAR_RE = re.compile(
+    "([" + "".join("\\U%08x-\\U%08x" % (first, last) for (first, last) in _CHINESE_CHAR_RANGES) + "])")
+_NON_BMP_RE = re.compile("[\\U00010000-\\U0010ffff]")
+_ASCII_CONTROL_RE = re.compile(_char_class_re(_CHAR_CLASSES[:0x80], _CONTROL))
+
+
+def _has_non_bmp(text):
+    """Checks whether `text` has characters outside the Basic Multilingual Plane."""
+    return not _is_ascii(text) and _NON_BMP_RE.search(text) is not None
+
+
+if hasattr(str, "isascii"):
+    def _is_ascii(text):
+        return text.isascii()
+else:
+    _NON_ASCII_RE = re.compile("[^\\x00-\\x7f]")
+
+    def _is_ascii(text):
+        return _NON_ASCII_RE.search(text) is None
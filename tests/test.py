@@ -17,6 +17,7 @@
 import pytest
 import requests
 import json
+import time
 
 einstein_text = open("tests/einstein.txt", "r").read()
 
@@ -49,6 +50,29 @@ def test_metadata():
     assert metadata['source'] == 'https://developer.ibm.com/exchanges/models/all/max-question-answering/'
 
 
+def test_metrics():
+
+    model_endpoint = 'http://localhost:5000/model/metrics'
+
+    r = requests.get(url=model_endpoint)
+    assert r.status_code == 200
+
+    response = r.json()
+    assert response['status'] == 'ok'
+    batching = response['metrics']['batching']
+    for key in ['queue_depth', 'batches', 'mean_batch_fill_ratio', 'mean_wait_ms']:
+        assert key in batching
+    windows = response['metrics']['windows']
+    for key in ['examples', 'windows', 'won_by_later_window', 'winning_window_histogram']:
+        assert key in windows
+    context_cache = response['metrics']['context_cache']
+    for key in ['hits', 'misses', 'evictions', 'size']:
+        assert key in context_cache
+    pipeline = response['metrics']['pipeline']
+    for stage in ['pre_process', 'predict', 'post_process']:
+        assert 'utilization' in pipeline[stage]
+
+
 def test_invalid():
     model_endpoint = 'http://localhost:5000/model/predict'
 
@@ -114,6 +138,10 @@ def test_valid():
     all_responses = response["predictions"]
     assert all_answers == all_responses
 
+    # the offsets of each answer point at its text in the context
+    for (answer, (start, end)) in zip(all_answers[0], response["offsets"][0]):
+        assert einstein_text[start:end] == answer
+
 
 def test_multiple_paragraphs():
     model_endpoint = 'http://localhost:5000/model/predict'
@@ -146,6 +174,188 @@ def test_multiple_paragraphs():
     assert all_answers == all_responses
 
 
+def test_stream():
+    model_endpoint = 'http://localhost:5000/model/predict'
+    json_data = {"paragraphs": [{"context": "John lives in Brussels and works for the EU",
+                                 "questions": ["Where does John Live?"]},
+                                {"context": "Jane lives in Paris and works for the UN",
+                                 "questions": ["Where does Jane Live?", "What does Jane do?"]}]}
+    r = requests.post(url=model_endpoint, json=json_data, headers={'Accept': 'application/x-ndjson'}, stream=True)
+    assert r.status_code == 200
+    assert r.headers['Content-Type'].startswith('application/x-ndjson')
+
+    # one line of answers per paragraph, in input order
+    lines = [json.loads(line) for line in r.iter_lines() if line]
+    assert [line['paragraph'] for line in lines] == [0, 1]
+    assert all(line['status'] == 'ok' for line in lines)
+    assert [line['predictions'] for line in lines] == [["Brussels"], ["Paris", "works for the UN"]]
+
+
+def test_n_best():
+    model_endpoint = 'http://localhost:5000/model/predict'
+    json_data = {"paragraphs": [{"context": einstein_text,
+                                 "questions": ["What did Albert Einstein discover?",
+                                               "What prize did Einstein receive?"
+                                               ]}],
+                 "n_best": 3}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    response = r.json()
+    assert response['status'] == 'ok'
+    assert response['predictions'] == [["the law of the photoelectric effect", "1921 Nobel Prize in Physics"]]
+
+    # the best span comes first, the probabilities are over the returned spans
+    for (answer, spans) in zip(response['predictions'][0], response['n_best'][0]):
+        assert 1 <= len(spans) <= 3
+        assert spans[0]['text'] == answer
+        assert abs(sum(span['probability'] for span in spans) - 1.0) < 1e-6
+        for span in spans:
+            assert einstein_text[span['start_char']:span['end_char']] == span['text']
+
+    # a single span is the answer, with all the probability
+    json_data['n_best'] = 1
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    response = r.json()
+    for (answer, spans) in zip(response['predictions'][0], response['n_best'][0]):
+        assert len(spans) == 1
+        assert spans[0]['text'] == answer
+        assert spans[0]['probability'] == 1.0
+
+    json_data['n_best'] = 0
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 400
+
+
+def test_anytime():
+    model_endpoint = 'http://localhost:5000/model/predict'
+    long_text = "\n\n".join([einstein_text] * 6)
+    json_data = {"paragraphs": [{"context": long_text,
+                                 "questions": ["What did Albert Einstein discover?",
+                                               "What prize did Einstein receive?"
+                                               ]}]}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    all_answers = r.json()['predictions']
+
+    # a threshold no answer reaches runs every window
+    json_data['anytime'] = {"threshold": 1.0}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    response = r.json()
+    assert response['predictions'] == all_answers
+    assert response['windows_skipped'] == [0]
+
+    # a budget of one window per question skips the others
+    json_data['anytime'] = {"max_windows": 2, "order": "overlap"}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    response = r.json()
+    assert response['windows_skipped'][0] > 0
+    assert all(response['predictions'][0])
+
+    json_data['anytime'] = {"threshold": 2}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 400
+
+
+def test_retrieval():
+    model_endpoint = 'http://localhost:5000/model/predict'
+    long_text = "\n\n".join([einstein_text] * 6)
+    json_data = {"paragraphs": [{"context": long_text,
+                                 "questions": ["What did Albert Einstein discover?",
+                                               "What prize did Einstein receive?"
+                                               ]}]}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    all_answers = r.json()['predictions']
+
+    # retrieving every passage answers from the whole context
+    json_data['retrieval'] = {"top_k": 1000}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    assert r.json()['predictions'] == all_answers
+
+    # the answers found in the best passage point into the whole context
+    json_data['retrieval'] = {"top_k": 1, "passage_size": 64}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    response = r.json()
+    for (answer, offsets) in zip(response['predictions'][0], response['offsets'][0]):
+        assert answer == " ".join(long_text[offsets[0]:offsets[1]].split())
+
+    json_data['retrieval'] = {"top_k": 0}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 400
+
+
+def test_jobs():
+    model_endpoint = 'http://localhost:5000/model/jobs'
+    json_data = {"paragraphs": [{"context": einstein_text,
+                                 "questions": ["What did Albert Einstein discover?",
+                                               "What prize did Einstein receive?"
+                                               ]}]}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 202
+    response = r.json()
+    assert response['status'] == 'ok'
+    job_id = response['job_id']
+
+    # poll the job until it is done
+    for _ in range(600):
+        r = requests.get(url=model_endpoint + '/' + job_id)
+        assert r.status_code == 200
+        response = r.json()
+        if response['job_status'] not in ['queued', 'running']:
+            break
+        time.sleep(0.1)
+    assert response['job_status'] == 'done'
+    assert response['features_done'] == response['features_total']
+    assert response['predictions'] == [["the law of the photoelectric effect", "1921 Nobel Prize in Physics"]]
+
+    r = requests.get(url=model_endpoint + '/unknown')
+    assert r.status_code == 404
+
+
+def test_documents():
+    r = requests.post(url='http://localhost:5000/model/documents', json={"context": einstein_text})
+    assert r.status_code == 200
+    response = r.json()
+    assert response['status'] == 'ok'
+    assert response['num_tokens'] > 0
+    doc_id = response['doc_id']
+
+    # paragraphs can refer to the registered context by its doc_id
+    model_endpoint = 'http://localhost:5000/model/predict'
+    json_data = {"paragraphs": [{"doc_id": doc_id,
+                                 "questions": ["What did Albert Einstein discover?",
+                                               "What prize did Einstein receive?"
+                                               ]}]}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    response = r.json()
+    assert response['status'] == 'ok'
+    assert response["predictions"] == [["the law of the photoelectric effect", "1921 Nobel Prize in Physics"]]
+
+    r = requests.post(url=model_endpoint, json={"paragraphs": [{"doc_id": "unknown", "questions": ["Who?"]}]})
+    assert r.status_code == 404
+
+    # an edited version of the context, tokenized again from the previous version
+    edited_text = einstein_text.replace("Albert Einstein", "Albert Einstein, the physicist,", 1)
+    r = requests.post(url='http://localhost:5000/model/documents', json={"context": edited_text, "base_doc_id": doc_id})
+    assert r.status_code == 200
+    edited_id = r.json()['doc_id']
+    assert edited_id != doc_id
+
+    json_data["paragraphs"][0]["doc_id"] = edited_id
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.status_code == 200
+    edited_predictions = r.json()["predictions"]
+    json_data["paragraphs"][0] = {"context": edited_text, "questions": json_data["paragraphs"][0]["questions"]}
+    r = requests.post(url=model_endpoint, json=json_data)
+    assert r.json()["predictions"] == edited_predictions
+
+
 def test_response():
     model_endpoint = 'http://localhost:5000/model/predict'
     file_path = 'samples/small-dev.json'
@@ -0,0 +1,95 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Run from the repository root: python -m pytest tests/test_decoding.py
+
+import numpy as np
+import pytest
+
+from core import decoding
+
+
+def test_best_spans_stay_within_a_segment():
+    # two passages that were not contiguous in the context, joined in one window
+    start_logits = np.array([[5.0, 0.0, 0.0, 0.0, 0.0]], dtype=np.float32)
+    end_logits = np.array([[0.0, 1.0, 0.0, 0.0, 5.0]], dtype=np.float32)
+    mask = np.ones((1, 5), dtype=bool)
+    segments = np.array([[0, 0, 0, 1, 1]])
+    (start_indexes, end_indexes, _) = decoding.best_spans(start_logits, end_logits, mask, mask, 30)
+    assert (start_indexes[0, 0], end_indexes[0, 0]) == (0, 4)
+    (start_indexes, end_indexes, scores) = decoding.best_spans(start_logits, end_logits, mask, mask, 30,
+                                                               n_best_size=20, segments=segments)
+    assert (start_indexes[0, 0], end_indexes[0, 0]) == (0, 1)
+    found = np.isfinite(scores[0])
+    assert np.all(segments[0, start_indexes[0, found]] == segments[0, end_indexes[0, found]])
+
+
+def brute_force_spans(start_logits, end_logits, start_mask, end_mask, max_answer_length):
+    """Every valid span of a window as `(-score, start, end)`, best first, ties by position."""
+    spans = []
+    for start in range(len(start_logits)):
+        for end in range(start, len(end_logits)):
+            if start_mask[start] and end_mask[end] and end - start + 1 < max_answer_length:
+                spans.append((-(start_logits[start] + end_logits[end]), start, end))
+    return sorted(spans)
+
+
+def random_windows(rng, n, length):
+    # small integer logits, so that there are ties to break
+    start_logits = rng.randint(-3, 4, size=(n, length)).astype(np.float32)
+    end_logits = rng.randint(-3, 4, size=(n, length)).astype(np.float32)
+    start_mask = rng.rand(n, length) < 0.7
+    end_mask = rng.rand(n, length) < 0.7
+    return start_logits, end_logits, start_mask, end_mask
+
+
+def test_best_spans_match_brute_force():
+    rng = np.random.RandomState(0)
+    for _ in range(200):
+        length = rng.randint(1, 16)
+        max_answer_length = rng.choice([1, 2, 3, 5, 30])
+        n_best_size = rng.choice([1, 2, 5, 1000])
+        (start_logits, end_logits, start_mask, end_mask) = random_windows(rng, 3, length)
+        (start_indexes, end_indexes, scores) = decoding.best_spans(
+            start_logits, end_logits, start_mask, end_mask, max_answer_length, n_best_size=n_best_size)
+
+        # with more spans asked for than the band holds, only the band is returned
+        width = max(min(max_answer_length - 1, length), 1)
+        assert scores.shape == (3, min(n_best_size, length * width))
+        for row in range(3):
+            expected = brute_force_spans(start_logits[row], end_logits[row], start_mask[row], end_mask[row],
+                                         max_answer_length)[:scores.shape[1]]
+            found = len(expected)
+            assert list(start_indexes[row, :found]) == [start for (_, start, _) in expected]
+            assert list(end_indexes[row, :found]) == [end for (_, _, end) in expected]
+            assert list(scores[row, :found]) == [-score for (score, _, _) in expected]
+            # the windows with too few valid spans are padded with -inf scores
+            assert np.all(scores[row, found:] == -np.inf)
+
+
+def test_best_spans_of_masked_windows():
+    start_logits = np.zeros((2, 4), dtype=np.float32)
+    end_logits = np.zeros((2, 4), dtype=np.float32)
+    mask = np.array([[False] * 4, [True] * 4])
+    (_, _, scores) = decoding.best_spans(start_logits, end_logits, mask, mask, 30)
+    assert scores[0, 0] == -np.inf and np.isfinite(scores[1, 0])
+    # a span of one token is already as long as a `max_answer_length` of 1
+    (_, _, scores) = decoding.best_spans(start_logits, end_logits, mask, mask, 1)
+    assert np.all(scores == -np.inf)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,295 @@
+#
+# Copyright 2018-2019 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Run from the repository root: python -m pytest tests/test_tokenization.py
+
+import os
+import random
+import unicodedata
+
+import pytest
+
+from benchmarks.samples import sample_contexts
+from core import run_squad, tokenization
+
+VOCAB_FILE = "assets/vocab.txt"
+
+
+def greedy_wordpiece(vocab, text, unk_token="[UNK]", max_input_chars_per_word=200):
+    """The original greedy longest-match-first WordPiece algorithm, as a reference."""
+    output_tokens = []
+    for token in tokenization.whitespace_tokenize(text):
+        chars = list(token)
+        if len(chars) > max_input_chars_per_word:
+            output_tokens.append(unk_token)
+            continue
+
+        is_bad = False
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if substr in vocab:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                is_bad = True
+                break
+            sub_tokens.append(cur_substr)
+            start = end
+
+        if is_bad:
+            output_tokens.append(unk_token)
+        else:
+            output_tokens.extend(sub_tokens)
+    return output_tokens
+
+
+class ReferenceBasicTokenizer(object):
+    """The original character by character BasicTokenizer, as a reference."""
+
+    def __init__(self, do_lower_case=True):
+        self.do_lower_case = do_lower_case
+
+    def tokenize(self, text):
+        text = self._clean_text(text)
+        text = self._tokenize_chinese_chars(text)
+        split_tokens = []
+        for token in tokenization.whitespace_tokenize(text):
+            if self.do_lower_case:
+                token = token.lower()
+                token = self._run_strip_accents(token)
+            split_tokens.extend(self._run_split_on_punc(token))
+        return tokenization.whitespace_tokenize(" ".join(split_tokens))
+
+    def _run_strip_accents(self, text):
+        text = unicodedata.normalize("NFD", text)
+        return "".join(char for char in text if unicodedata.category(char) != "Mn")
+
+    def _run_split_on_punc(self, text):
+        start_new_word = True
+        output = []
+        for char in text:
+            if tokenization._is_punctuation(char):
+                output.append([char])
+                start_new_word = True
+            else:
+                if start_new_word:
+                    output.append([])
+                start_new_word = False
+                output[-1].append(char)
+        return ["".join(x) for x in output]
+
+    def _tokenize_chinese_chars(self, text):
+        output = []
+        for char in text:
+            cp = ord(char)
+            if ((0x4E00 <= cp <= 0x9FFF) or (0x3400 <= cp <= 0x4DBF) or (0x20000 <= cp <= 0x2A6DF) or
+                    (0x2A700 <= cp <= 0x2B73F) or (0x2B740 <= cp <= 0x2B81F) or (0x2B820 <= cp <= 0x2CEAF) or
+                    (0xF900 <= cp <= 0xFAFF) or (0x2F800 <= cp <= 0x2FA1F)):
+                output.extend([" ", char, " "])
+            else:
+                output.append(char)
+        return "".join(output)
+
+    def _clean_text(self, text):
+        output = []
+        for char in text:
+            cp = ord(char)
+            if cp == 0 or cp == 0xfffd or tokenization._is_control(char):
+                continue
+            output.append(" " if tokenization._is_whitespace(char) else char)
+        return "".join(output)
+
+
+def unicode_corpus():
+    """Every BMP character between ASCII letters, random strings across all planes, and the sample corpora."""
+    texts = []
+    bmp = [chr(cp) for cp in range(1, 0x10000) if not 0xD800 <= cp <= 0xDFFF]
+    for i in range(0, len(bmp), 256):
+        texts.append("".join("a" + char + "b " for char in bmp[i:i + 256]))
+        texts.append("".join(bmp[i:i + 256]))
+
+    rng = random.Random(7)
+    pools = ["abcXYZ019 .,;'-", "\u00e9\u00c9\u0301\u0327\u4e2d\u6587\uff01\u3000\u200b\t\n\r\u00a0", ""]
+    for _ in range(2000):
+        chars = []
+        for _ in range(rng.randint(0, 40)):
+            pool = rng.choice(pools)
+            chars.append(rng.choice(pool) if pool else random_unicode_char(rng))
+        texts.append("".join(chars))
+    return texts + corpus_texts()
+
+
+def random_word(rng, alphabet, max_length=12):
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(1, max_length)))
+
+
+def random_unicode_char(rng):
+    # mostly BMP characters, some from the supplementary planes
+    while True:
+        cp = rng.randint(0x21, 0xFFFF) if rng.random() < 0.9 else rng.randint(0x10000, 0x10FFFF)
+        if not 0xD800 <= cp <= 0xDFFF:
+            return chr(cp)
+
+
+def synthetic_vocab(rng, alphabet, size=2000):
+    vocab = {"[UNK]": 0}
+    while len(vocab) < size:
+        piece = random_word(rng, alphabet, max_length=6)
+        if rng.random() < 0.5:
+            piece = "##" + piece
+        vocab.setdefault(piece, len(vocab))
+    for char in alphabet[:len(alphabet) // 2]:
+        vocab.setdefault(char, len(vocab))
+        vocab.setdefault("##" + char, len(vocab))
+    return vocab
+
+
+def corpus_texts():
+    (contexts, questions) = sample_contexts()
+    return contexts + questions
+
+
+def corpus_words():
+    texts = corpus_texts()
+    basic_tokenizer = tokenization.BasicTokenizer(do_lower_case=True)
+    return [word for text in texts for word in basic_tokenizer.tokenize(text)]
+
+
+def vocabs():
+    rng = random.Random(1234)
+    alphabet = [random_unicode_char(rng) for _ in range(30)] + list("abcdefghijklmnopqrstuvwxyz#")
+    yield synthetic_vocab(rng, alphabet), alphabet
+    if os.path.exists(VOCAB_FILE):
+        vocab = tokenization.load_vocab(VOCAB_FILE)
+        yield vocab, sorted(set("".join(vocab)))
+
+
+def test_wordpiece_matches_greedy_on_random_words():
+    rng = random.Random(42)
+    for (vocab, alphabet) in vocabs():
+        tokenizer = tokenization.WordpieceTokenizer(vocab=vocab, max_input_chars_per_word=20)
+        for _ in range(20000):
+            if rng.random() < 0.9:
+                word = random_word(rng, alphabet, max_length=24)
+            else:
+                word = "".join(random_unicode_char(rng) for _ in range(rng.randint(1, 8)))
+            assert tokenizer.tokenize(word) == greedy_wordpiece(vocab, word, max_input_chars_per_word=20), word
+
+
+def test_wordpiece_matches_greedy_on_sample_corpora():
+    words = corpus_words()
+    for (vocab, _) in vocabs():
+        tokenizer = tokenization.WordpieceTokenizer(vocab=vocab)
+        assert tokenizer.tokenize(" ".join(words)) == greedy_wordpiece(vocab, " ".join(words))
+        for word in words:
+            assert tokenizer.tokenize(word) == greedy_wordpiece(vocab, word), word
+
+
+def test_basic_tokenizer_matches_reference_on_unicode_corpus():
+    for do_lower_case in [True, False]:
+        tokenizer = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
+        reference = ReferenceBasicTokenizer(do_lower_case=do_lower_case)
+        for text in unicode_corpus():
+            assert tokenizer.tokenize(text) == reference.tokenize(text), repr(text)
+
+
+def corpus_vocab_file(tmp_path):
+    vocab_file = str(tmp_path / "vocab.txt")
+    words = corpus_words()
+    with open(vocab_file, "w") as f:
+        # whole words for half the corpus, characters for the rest
+        pieces = ["[UNK]"] + sorted(set(words[::2])) + sorted(set("".join(words))) + \
+            sorted(set("##" + c for c in "".join(words)))
+        f.write("\n".join(pieces) + "\n")
+    return vocab_file
+
+
+def test_word_cache_does_not_change_tokenization(tmp_path):
+    vocab_file = corpus_vocab_file(tmp_path)
+    text = " ".join(corpus_texts() * 3)
+    uncached = tokenization.FullTokenizer(vocab_file)
+    cached = tokenization.FullTokenizer(vocab_file, word_cache_size=50)
+    tokens, ids = cached.tokenize_to_ids(text)
+    assert tokens == uncached.tokenize(text)
+    assert ids == uncached.convert_tokens_to_ids(tokens)
+    assert cached.tokenize(text) == tokens
+    stats = cached.word_cache.stats()
+    assert stats["hits"] > 0 and stats["evictions"] > 0 and stats["entries"] <= 50
+
+
+def test_incremental_update_matches_full_tokenization(tmp_path):
+    tokenizer = tokenization.FullTokenizer(corpus_vocab_file(tmp_path))
+    words = corpus_words()
+    rng = random.Random(7)
+
+    def tokenized(text):
+        (doc_tokens, doc_token_starts) = run_squad.doc_token_spans(text)
+        assert doc_tokens == run_squad.split_doc_tokens(text)[0]
+        return run_squad.tokenize_context(doc_tokens, tokenizer, doc_token_starts=doc_token_starts)
+
+    for _ in range(2000):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(0, 20)))
+        # replace a random range, which may split words or merge them across whitespace
+        start = rng.randint(0, len(text))
+        end = rng.randint(start, min(len(text), start + 12))
+        insert = rng.choice(["", " ", "\n", rng.choice(words), " {} ".format(rng.choice(words)), rng.choice(words)[:2]])
+        new_text = text[:start] + insert + text[end:]
+
+        updated = run_squad.update_context(tokenized(text), text, new_text, tokenizer)
+        expected = tokenized(new_text)
+        assert updated.doc_tokens == expected.doc_tokens, (text, new_text)
+        for name in ["all_doc_token_ids", "tok_to_orig_index", "orig_to_tok_index", "doc_token_starts", "wordpiece_starts",
+                     "wordpiece_ends"]:
+            assert getattr(updated, name).tolist() == getattr(expected, name).tolist(), (name, text, new_text)
+
+
+def test_wordpiece_offsets_point_at_their_characters(tmp_path):
+    tokenizer = tokenization.FullTokenizer(corpus_vocab_file(tmp_path))
+    for text in unicode_corpus() + corpus_texts():
+        for word in text.split():
+            (pieces, _, starts, ends) = tokenizer.tokenize_with_offsets(word)
+            assert pieces == tokenizer.tokenize(word)
+            for (piece, start, end) in zip(pieces, starts, ends):
+                if piece == "[UNK]":
+                    continue
+                # the characters of a piece tokenize to the piece (without its "##")
+                expected = piece[2:] if piece.startswith("##") and len(piece) > 2 else piece
+                assert "".join(tokenizer.basic_tokenizer.tokenize(word[start:end])) == expected, (word, piece)
+
+
+def test_max_context_spans_match_the_per_token_scan():
+    rng = random.Random(13)
+    for _ in range(300):
+        num_doc_tokens = rng.randint(1, 400)
+        max_tokens_for_doc = rng.randint(1, 120)
+        doc_stride = rng.randint(1, 150)
+        (doc_spans, max_context_span) = run_squad._doc_span_layout(num_doc_tokens, max_tokens_for_doc, doc_stride)
+        for (span_index, doc_span) in enumerate(doc_spans):
+            for position in range(doc_span.start, doc_span.start + doc_span.length):
+                assert run_squad._check_is_max_context(doc_spans, span_index, position) == \
+                    (max_context_span[position] == span_index), (num_doc_tokens, max_tokens_for_doc, doc_stride)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -155,6 +155,12 @@ flags.DEFINE_float(
 
 flags.DEFINE_string("output_file_name", "predictions", "What file name predictions are written to.")
 
+flags.DEFINE_bool(
+    "export_dynamic_seq_length", False,
+    "If true, the exported SavedModel accepts inputs of any sequence length up "
+    "to `max_seq_length`, so that short inputs do not need to be padded to "
+    "`max_seq_length` at inference time.")
+
 
 class SquadExample(object):
     """A single training/test example for simple sequence classification.
@@ -745,13 +751,16 @@ def input_fn_builder(input_file, seq_length, is_training, drop_remainder):
 
 
 def serving_input_fn():
+    # with a dynamic sequence length the position embeddings are sliced to the
+    # length of the batch, which must not exceed `max_seq_length`
+    seq_length = None if FLAGS.export_dynamic_seq_length else FLAGS.max_seq_length
     unique_ids = tf.placeholder(tf.int32, [None], name='unique_ids')
     input_ids = tf.placeholder(
-        tf.int32, [None, FLAGS.max_seq_length], name='input_ids')
+        tf.int32, [None, seq_length], name='input_ids')
     input_mask = tf.placeholder(
-        tf.int32, [None, FLAGS.max_seq_length], name='input_mask')
+        tf.int32, [None, seq_length], name='input_mask')
     segment_ids = tf.placeholder(
-        tf.int32, [None, FLAGS.max_seq_length], name='segment_ids')
+        tf.int32, [None, seq_length], name='segment_ids')
     input_fn = tf.estimator.export.build_raw_serving_input_receiver_fn({
         'unique_ids': unique_ids,
         'input_ids': input_ids,
@@ -90,7 +90,7 @@ echo "# Training model ..."
 echo "# **********************************************************"
 
 # start training and capture return code
-TRAINING_CMD="python3 run_squad.py --MODEL_DOWNLOAD_BASE=$MODEL_DOWNLOAD_BASE --MODEL_FILE=$MODEL_FILE --MODEL_FOLDER=$MODEL_FOLDER --train_file=$TRAINING_DATA --do_lower_case=$DO_LOWER_CASE --max_seq_length=$MAX_SEQ_LENGTH --learning_rate=$LEARNING_RATE --num_train_epochs=$NUM_TRAIN_EPOCHS --warmup_proportion=$WARMUP_PROPORTION --train_batch_size=$TRAIN_BATCH_SIZE --output_dir=$RESULT_DIR"
+TRAINING_CMD="python3 run_squad.py --MODEL_DOWNLOAD_BASE=$MODEL_DOWNLOAD_BASE --MODEL_FILE=$MODEL_FILE --MODEL_FOLDER=$MODEL_FOLDER --train_file=$TRAINING_DATA --do_lower_case=$DO_LOWER_CASE --max_seq_length=$MAX_SEQ_LENGTH --export_dynamic_seq_length=$EXPORT_DYNAMIC_SEQ_LENGTH --learning_rate=$LEARNING_RATE --num_train_epochs=$NUM_TRAIN_EPOCHS --warmup_proportion=$WARMUP_PROPORTION --train_batch_size=$TRAIN_BATCH_SIZE --output_dir=$RESULT_DIR"
 
 # display training command
 echo "Running training command \"$TRAINING_CMD\""
@@ -8,6 +8,8 @@ MODEL_FOLDER="uncased_L-12_H-768_A-12"
 # model-specific:
 DO_LOWER_CASE=true  # changing this parameter also requires changing the same parameter in `core/model.py` for inference
 MAX_SEQ_LENGTH=512  # changing this parameter also requires changing the same parameter in `core/model.py` for inference
+# export a model that accepts any sequence length up to MAX_SEQ_LENGTH (enables length-bucketed inference)
+EXPORT_DYNAMIC_SEQ_LENGTH=false
 # general:
 NUM_TRAIN_EPOCHS=1
 TRAIN_BATCH_SIZE=6